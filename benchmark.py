@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# mcp_rebuild - A Python script for safe and easy rebuilding of MCP projects.
+# Copyright (c) 2011 FunnyMan3595 (Charlie Nolan)
+# This code is made avilable under the MIT license.  See LICENSE for the full
+# details.
+
+# Benchmarks rebuild.py against a synthetic MCP workspace, so that changes to
+# its speed can be measured without a real MCP install.
+#
+# The workspace holds a fake decompiled source tree, fake SRG files, and
+# recompile/reobfuscate scripts that call back into this file to emit
+# (minimal, but valid) class files.  rebuild.py runs against it with a
+# generated settings.py, and the timings come from its build report.
+
+import argparse, json, os, os.path, platform, shutil, struct, subprocess, \
+       sys, tempfile, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The phases worth comparing between runs.  The stub recompile and reobfuscate
+# phases are timed too, but they measure this file, not rebuild.py.
+PHASES = ("reset", "collect_projects", "install", "install_precompiled",
+          "srg_load", "index_reobf", "package")
+
+# Every file in the clean source gets this mtime, so the stub reobfuscator can
+# tell it apart from files installed by projects.
+CLEAN_MTIME = 1293840000 # 2011-01-01
+MARKER = ".benchmark_clean"
+
+WINDOWS = (platform.system() == "Windows")
+
+parser = argparse.ArgumentParser(
+    description="Benchmark rebuild.py against a synthetic MCP workspace.")
+parser.add_argument("--projects", type=int, default=50,
+                    help="number of projects (default: 50)")
+parser.add_argument("--files", type=int, default=20,
+                    help="source files per project (default: 20)")
+parser.add_argument("--resources", type=int, default=10,
+                    help="resource files per project (default: 10)")
+parser.add_argument("--resource-size", type=int, default=16384,
+                    help="bytes per resource file (default: 16384)")
+parser.add_argument("--classes", type=int, default=2000,
+                    help="classes in the clean source tree (default: 2000)")
+parser.add_argument("--class-size", type=int, default=8192,
+                    help="bytes per clean source file (default: 8192)")
+parser.add_argument("--srg-extra", type=int, default=20000,
+                    help="FD:/MD: lines per SRG file (default: 20000)")
+parser.add_argument("--runs", type=int, default=3,
+                    help="timed builds to run (default: 3)")
+parser.add_argument("--cold", action="store_true",
+                    help="delete the build cache and SRG index before each "
+                         "run")
+parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                    help="override a setting for rebuild.py, e.g. "
+                         "--set SNAPSHOT_FORMAT='\"links\"'")
+parser.add_argument("--args", default="",
+                    help="extra arguments for rebuild.py, e.g. \"-j 4\"")
+parser.add_argument("--workspace",
+                    help="where to build the synthetic workspace (default: a "
+                         "temporary directory)")
+parser.add_argument("--keep", action="store_true",
+                    help="don't delete the workspace afterwards")
+parser.add_argument("--output",
+                    help="where to save the results (default: "
+                         "benchmarks/<time>.json next to this file)")
+parser.add_argument("--compare", metavar="RESULTS",
+                    help="compare against earlier saved results")
+parser.add_argument("--stub", choices=("recompile", "reobfuscate"),
+                    help=argparse.SUPPRESS)
+parser.add_argument("--base", help=argparse.SUPPRESS)
+
+
+def class_file(name, outer=None):
+    """Builds a minimal class file for the internal name name.
+
+       If outer is given, the class is marked as a member of it.
+    """
+    pool = []
+    def utf8(value):
+        pool.append(b"\x01" + struct.pack(">H", len(value)) + value)
+        return len(pool)
+    def class_ref(value):
+        index = utf8(value)
+        pool.append(b"\x07" + struct.pack(">H", index))
+        return len(pool)
+
+    this_class = class_ref(name)
+    super_class = class_ref(b"java/lang/Object")
+    attributes = []
+    if outer is not None:
+        outer_class = class_ref(outer)
+        attribute_name = utf8(b"InnerClasses")
+        inner_name = utf8(name.rsplit(b"$", 1)[-1])
+        body = struct.pack(">HHHHH", 1, this_class, outer_class, inner_name,
+                           0x0008)
+        attributes.append(struct.pack(">HI", attribute_name, len(body))
+                          + body)
+
+    return (b"\xca\xfe\xba\xbe" + struct.pack(">HHH", 0, 50, len(pool) + 1)
+            + b"".join(pool)
+            + struct.pack(">HHHHHHH", 0x21, this_class, super_class, 0, 0, 0,
+                          len(attributes))
+            + b"".join(attributes))
+
+def write_file(filename, data, mtime=None):
+    dir = os.path.dirname(filename)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    with open(filename, "wb") as file:
+        file.write(data)
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+def padded(text, size):
+    """Pads text out to size bytes with a Java comment."""
+    text += "\n// "
+    return (text + "x" * max(0, size - len(text) - 1) + "\n").encode("utf-8")
+
+
+def generate(base, options):
+    """Builds the synthetic MCP workspace and USER tree under base."""
+    print "Generating workspace in %s..." % base
+    sides = (("minecraft", "client", "a"), ("minecraft_server", "server", "b"))
+
+    for (side, srg, prefix) in sides:
+        lines = []
+        for number in range(options.classes):
+            plain = "net/minecraft/src/Class%d" % number
+            write_file(os.path.join(base, "src", side, plain + ".java"),
+                       padded("package net.minecraft.src;\n"
+                              "public class Class%d {}" % number,
+                              options.class_size),
+                       CLEAN_MTIME)
+            lines.append("CL: %s%d %s\n" % (prefix, number, plain))
+
+        for number in range(options.srg_extra):
+            owner = number % max(options.classes, 1)
+            if number % 2:
+                lines.append("FD: %s%d/f%d net/minecraft/src/Class%d/field%d\n"
+                             % (prefix, owner, number, owner, number))
+            else:
+                lines.append("MD: %s%d/m%d ()V net/minecraft/src/Class%d/"
+                             "method%d ()V\n"
+                             % (prefix, owner, number, owner, number))
+
+        write_file(os.path.join(base, "conf", srg + ".srg"),
+                   "".join(lines).encode("utf-8"))
+
+    write_file(os.path.join(base, MARKER), b"", CLEAN_MTIME + 1)
+
+    # MCP's scripts, which hand over to this file.  They find the workspace
+    # from their own location, so that copies of it (like --isolated's
+    # sandboxes) act on themselves.  ("%~dp0." stops the trailing backslash
+    # of %~dp0 from escaping the closing quote.)
+    for stub in ("recompile", "reobfuscate"):
+        if WINDOWS:
+            write_file(os.path.join(base, stub + ".bat"),
+                       ('@"%s" "%s" --stub %s --base "%%~dp0."\r\n'
+                        % (sys.executable, os.path.abspath(__file__), stub)
+                        ).encode("utf-8"))
+        else:
+            script = os.path.join(base, stub + ".sh")
+            write_file(script,
+                       ('#!/bin/sh\nexec "%s" "%s" --stub %s '
+                        '--base "$(dirname "$0")"\n'
+                        % (sys.executable, os.path.abspath(__file__), stub)
+                        ).encode("utf-8"))
+            os.chmod(script, 0o755)
+
+    # mcp_rebuild itself, configured for the workspace.
+    rebuild_dir = os.path.join(base, "mcp_rebuild")
+    os.makedirs(rebuild_dir)
+    shutil.copy2(os.path.join(HERE, "rebuild.py"), rebuild_dir)
+    with open(os.path.join(HERE, "settings.py")) as settings:
+        lines = [line for line in settings
+                 if not line.startswith(("BASE ", "UNCONFIGURED "))]
+    lines.append('\nBASE = r"%s"\n' % base)
+    for setting in options.set:
+        lines.append("%s\n" % setting)
+    lines.append("UNCONFIGURED = False\n")
+    write_file(os.path.join(rebuild_dir, "settings.py"),
+               "".join(lines).encode("utf-8"))
+
+    # And finally the user's projects.
+    user = os.path.join(rebuild_dir, "projects")
+    write_file(os.path.join(user, "CATEGORY"), b"")
+    for number in range(options.projects):
+        project = os.path.join(user, "project%03d" % number)
+        write_file(os.path.join(project, "conf", "VERSION"), b"1.0\n")
+
+        package = os.path.join(project, "src", "common", "net", "minecraft",
+                               "src")
+        for file in range(options.files):
+            name = "mod_P%dF%d" % (number, file)
+            # Every fifth class gets an inner class.
+            body = "public class %s {%s}" \
+                   % (name, " // inner" if file % 5 == 0 else "")
+            write_file(os.path.join(package, name + ".java"),
+                       padded("package net.minecraft.src;\n" + body, 2048))
+
+        # Each project also overrides one of Minecraft's classes, and adds a
+        # client-only class and a precompiled library.
+        if options.classes:
+            vanilla = number % options.classes
+            write_file(os.path.join(package, "Class%d.java" % vanilla),
+                       padded("package net.minecraft.src;\npublic class "
+                              "Class%d { /* project%03d */ }"
+                              % (vanilla, number), options.class_size))
+        write_file(os.path.join(project, "src", "client", "net", "minecraft",
+                                "src", "Gui%d.java" % number),
+                   padded("package net.minecraft.src;\npublic class Gui%d {}"
+                          % number, 2048))
+        write_file(os.path.join(project, "bin", "common", "lib",
+                                "Library%d.class" % number),
+                   class_file(("lib/Library%d" % number).encode("utf-8")))
+
+        for file in range(options.resources):
+            side = "client" if file % 3 == 2 else "common"
+            write_file(os.path.join(project, "resources", side,
+                                    "resource%d.dat" % file),
+                       os.urandom(options.resource_size // 2)
+                       + b"\0" * (options.resource_size
+                                  - options.resource_size // 2))
+
+    return rebuild_dir
+
+
+def stub_recompile(base):
+    """Stands in for recompile.sh: compiles every out-of-date source file."""
+    for side in ("minecraft", "minecraft_server"):
+        src = os.path.join(base, "src", side)
+        bin = os.path.join(base, "bin", side)
+        for (dir, subdirs, files) in os.walk(src):
+            for file in files:
+                if not file.endswith(".java"):
+                    continue
+                source = os.path.join(dir, file)
+                relative = os.path.relpath(source, src)[:-len(".java")]
+                target = os.path.join(bin, relative + ".class")
+                if os.path.exists(target) \
+                   and os.path.getmtime(target) == os.path.getmtime(source):
+                    continue
+
+                name = relative.replace(os.path.sep, "/").encode("utf-8")
+                write_file(target, class_file(name))
+                with open(source, "rb") as java:
+                    inner = b"// inner" in java.read()
+                if inner:
+                    write_file(os.path.join(bin, relative + "$Inner.class"),
+                               class_file(name + b"$Inner", name))
+                mtime = os.path.getmtime(source)
+                os.utime(target, (mtime, mtime))
+
+def stub_reobfuscate(base):
+    """Stands in for reobfuscate.sh.
+
+       Like the real thing, it only outputs classes that differ from the
+       clean source (here: those compiled from files newer than the marker),
+       renamed with the SRG files.
+    """
+    clean = os.path.getmtime(os.path.join(base, MARKER))
+    reobf = os.path.join(base, "reobf")
+    if os.path.exists(reobf):
+        shutil.rmtree(reobf)
+
+    for (side, srg) in (("minecraft", "client"),
+                        ("minecraft_server", "server")):
+        obfuscation = {}
+        with open(os.path.join(base, "conf", srg + ".srg")) as srg_file:
+            for line in srg_file:
+                if line.startswith("CL:"):
+                    prefix, obfuscated, plain = line.split()
+                    obfuscation[plain] = obfuscated
+
+        bin = os.path.join(base, "bin", side)
+        for (dir, subdirs, files) in os.walk(bin):
+            for file in files:
+                compiled = os.path.join(dir, file)
+                if os.path.getmtime(compiled) <= clean:
+                    continue
+
+                name = os.path.relpath(compiled, bin)[:-len(".class")]
+                name = name.replace(os.path.sep, "/")
+                outer, dollar, inner = name.partition("$")
+                outer = obfuscation.get(outer, outer)
+                if outer.startswith("net/minecraft/src/"):
+                    outer = outer[len("net/minecraft/src/"):]
+                name = outer + dollar + inner
+                write_file(os.path.join(reobf, side, name + ".class"),
+                           class_file(name.encode("utf-8"),
+                                      outer.encode("utf-8") if inner
+                                      else None))
+
+
+def run_build(rebuild_dir, options, report, answer=b"y\n"):
+    """Runs rebuild.py once, returning its report."""
+    command = [sys.executable, os.path.join(rebuild_dir, "rebuild.py"),
+               "--no-cache", "--report", report] + options.args.split()
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(command, cwd=rebuild_dir,
+                                   stdin=subprocess.PIPE, stdout=devnull)
+        process.communicate(answer)
+    if process.returncode != 0:
+        print "rebuild.py failed with exit code %d." % process.returncode
+        sys.exit(1)
+
+    with open(report) as report_file:
+        return json.load(report_file)
+
+def summarize(runs):
+    """Returns the minimum and median time for each phase across runs."""
+    summary = {}
+    for phase in PHASES:
+        times = sorted(sum(entry["seconds"] for entry in run["phases"]
+                           if entry["name"] == phase)
+                       for run in runs)
+        summary[phase] = {"min": times[0], "median": times[len(times) // 2]}
+    totals = sorted(run["seconds"] for run in runs)
+    summary["total"] = {"min": totals[0], "median": totals[len(totals) // 2]}
+    return summary
+
+def print_summary(summary, previous=None):
+    header = "%-20s %10s %10s" % ("phase", "min (s)", "median (s)")
+    if previous is not None:
+        header += " %10s %8s" % ("was (s)", "change")
+    print header
+    for phase in PHASES + ("total",):
+        line = "%-20s %10.3f %10.3f" % (phase, summary[phase]["min"],
+                                        summary[phase]["median"])
+        if previous is not None and phase in previous:
+            was = previous[phase]["median"]
+            change = (summary[phase]["median"] - was) / was * 100 if was \
+                     else 0.0
+            line += " %10.3f %+7.1f%%" % (was, change)
+        print line
+
+
+def main():
+    options = parser.parse_args()
+    if options.stub == "recompile":
+        return stub_recompile(options.base)
+    elif options.stub == "reobfuscate":
+        return stub_reobfuscate(options.base)
+
+    workspace = options.workspace or tempfile.mkdtemp(prefix="mcp_bench_")
+    base = os.path.abspath(os.path.join(workspace, "mcp"))
+    if os.path.exists(base):
+        print "%s already exists; refusing to overwrite it." % base
+        sys.exit(1)
+
+    try:
+        rebuild_dir = generate(base, options)
+        report = os.path.join(workspace, "report.json")
+
+        print "Creating the source bundle..."
+        run_build(rebuild_dir, options, report)
+
+        runs = []
+        for run in range(options.runs):
+            if options.cold:
+                for path in ("cache", "srg.index"):
+                    path = os.path.join(rebuild_dir, path)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    elif os.path.exists(path):
+                        os.remove(path)
+            print "Run %d of %d..." % (run + 1, options.runs)
+            runs.append(run_build(rebuild_dir, options, report))
+    finally:
+        if options.keep:
+            print "Workspace kept in %s." % workspace
+        else:
+            shutil.rmtree(workspace)
+
+    parameters = dict((key, value) for (key, value) in vars(options).items()
+                      if key not in ("stub", "base", "workspace", "keep",
+                                     "output", "compare"))
+    results = {
+        "when": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "summary": summarize(runs),
+        "runs": runs,
+    }
+
+    output = options.output
+    if output is None:
+        output = os.path.join(HERE, "benchmarks",
+                              time.strftime("%Y%m%d-%H%M%S.json"))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+
+    print
+    previous = None
+    if options.compare:
+        with open(options.compare) as previous_file:
+            previous = json.load(previous_file)
+        if previous["parameters"] != parameters:
+            print "Warning: %s was run with different parameters." \
+                  % options.compare
+        previous = previous["summary"]
+    print_summary(results["summary"], previous)
+    print
+    print "Results saved to %s." % output
+
+
+if __name__ == "__main__":
+    main()
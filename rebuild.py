@@ -4,8 +4,20 @@
 # This code is made avilable under the MIT license.  See LICENSE for the full
 # details.
 
-import itertools, os, os.path, platform, shutil, subprocess, sys, tarfile, \
-       zipfile
+import argparse, collections, ConfigParser, contextlib, cProfile, ctypes, \
+       ctypes.util, filecmp, hashlib, itertools, json, marshal, \
+       multiprocessing, os, os.path, platform, re, select, shlex, shutil, \
+       socket, stat, struct, subprocess, sys, tarfile, tempfile, threading, \
+       time, traceback, zipfile, zlib
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows.
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None # Everything else.
 
 import settings
 
@@ -17,6 +29,7 @@ BUNDLE_MISSING     = negative.next()
 UNSAFE_DELETE      = negative.next()
 BAD_BUNDLE         = negative.next()
 SRC_INSTALL_FAILED = negative.next()
+SERVER_FAILED      = negative.next()
 # Positive: Failure during or after compiling.
 positive = itertools.count(1)      # Returns -1, -2, -3, etc.
 RECOMPILE_FAILED   = positive.next()
@@ -24,37 +37,194 @@ BIN_INSTALL_FAILED = positive.next()
 REOBFUSCATE_FAILED = positive.next()
 PACKAGE_FAILED     = positive.next()
 
-if settings.UNCONFIGURED:
-    print "mcp_rebuild has not been configured properly!"
-    print "Edit config.py and try again."
-    sys.exit(UNCONFIGURED)
+
+# Raised to stop a build with one of the exit codes above.  It's a SystemExit,
+# so if nothing catches it, the script exits with that code.
+class BuildFailed(SystemExit):
+    pass
+
+# The ways SOURCE_BUNDLE can be stored.  See settings.py.
+SNAPSHOT_FORMATS = ("tar", "gz", "bz2", "xz", "links")
+# The ways user files can be put into MCP.  See settings.py.
+INSTALL_MODES = ("copy", "reflink", "hardlink", "symlink")
+
+parser = argparse.ArgumentParser(
+    description="Install, recompile, reobfuscate and package MCP projects.")
+parser.add_argument("--no-cache", action="store_true",
+                    help="always recompile and reobfuscate, ignoring (but "
+                         "still updating) the build cache")
+parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                    help="package up to N projects at once (default: 1)")
+parser.add_argument("--only", action="append", metavar="PROJECT",
+                    help="only install and package PROJECT, given by name or "
+                         "by directory; may be repeated")
+parser.add_argument("--steps", metavar="STEP,...",
+                    type=lambda steps: steps.split(","),
+                    default=["reset", "install", "recompile", "package"],
+                    help="run only these steps, out of reset, install, "
+                         "recompile and package (default: all of them)")
+parser.add_argument("--watch", action="store_true",
+                    help="stay running, rebuilding whenever a project changes")
+parser.add_argument("--report", metavar="FILE",
+                    help="write the build's timing report to FILE instead of "
+                         "BUILD_REPORT")
+parser.add_argument("--profile", metavar="FILE",
+                    help="profile the build with cProfile, saving the stats "
+                         "to FILE (packaging workers are not profiled)")
+parser.add_argument("--workspace", metavar="NAME",
+                    help="build in the workspace NAME from WORKSPACES")
+parser.add_argument("--matrix", action="store_true",
+                    help="build in every workspace in WORKSPACES")
+parser.add_argument("--matrix-jobs", type=int, metavar="N",
+                    help="with --matrix, build in up to N workspaces at once "
+                         "(default: MATRIX_JOBS)")
+parser.add_argument("--isolated", action="store_true",
+                    help="build each project (or SANDBOX group of projects) "
+                         "in its own copy of MCP, so that one failing "
+                         "project doesn't fail the rest")
+parser.add_argument("--sandbox-jobs", type=int, metavar="N",
+                    help="with --isolated, build in up to N sandboxes at once "
+                         "(default: SANDBOX_JOBS)")
+parser.add_argument("--serve", metavar="SOCKET",
+                    help="stay running as a build server, taking requests on "
+                         "the Unix socket SOCKET")
+parser.add_argument("--connect", metavar="SOCKET",
+                    help="ask the build server on SOCKET to do the build, "
+                         "instead of doing it here")
+parser.add_argument("--convert-bundle", metavar="FORMAT",
+                    choices=SNAPSHOT_FORMATS,
+                    help="rewrite SOURCE_BUNDLE in FORMAT (one of %s) and exit"
+                         % ", ".join(SNAPSHOT_FORMATS))
 
 # Convenience functions.  These make the settings settings easier to work with.
 absolute = lambda rawpath: os.path.abspath(os.path.expanduser(rawpath))
 relative = lambda relpath: absolute(os.path.join(BASE, relpath))
+# BASE settings are relative to this script's directory, not to wherever the
+# script was started from (or imported by).
+from_script = lambda rawpath: absolute(
+    os.path.join(os.path.dirname(SCRIPT), os.path.expanduser(rawpath)))
+
+# Which of settings.WORKSPACES this process builds in, if any.  Every path
+# below depends on it, so it has to be known before the script starts; --matrix
+# and --workspace pass it to the builds they start through the environment.
+WORKSPACE = os.environ.get("MCP_REBUILD_WORKSPACE") or None
+# This script and the directory it was started in, for starting more builds
+# that see the same paths.  Found now, in case whatever imported the script
+# changes the working directory.
+SCRIPT = os.path.abspath(__file__)
+START_DIR = os.getcwd()
+# Which sandbox under SANDBOXES this process builds in, if any.  Set by
+# --isolated for the builds it starts.
+SANDBOX = os.environ.get("MCP_REBUILD_SANDBOX") or None
 
 # See settings.py for documenation on what these do.
-BASE = absolute(settings.BASE)
+BASE = from_script(settings.BASE)
+# mcp_rebuild's own files (its caches, indexes and reports) stay with this
+# BASE even when building somewhere else, since the other MCP may have nowhere
+# to put them.  Each workspace keeps its own in a subdirectory named after it,
+# beside the main ones.  STATE_DIRS collects the directories they go in.
+MAIN_BASE = BASE
+STATE_DIRS = set()
+def state_path(path):
+    path = absolute(os.path.join(MAIN_BASE, path))
+    STATE_DIRS.add(os.path.dirname(path))
+    if WORKSPACE is not None:
+        path = os.path.join(os.path.dirname(path), WORKSPACE,
+                            os.path.basename(path))
+    return path
 USER = relative(settings.USER)
 TARGET = relative(settings.TARGET)
 SOURCE_BUNDLE = relative(settings.SOURCE_BUNDLE)
-
-# Most of this script assumes it's in the MCP directory, so let's go there.
-os.chdir(BASE)
-
-# Create the project directory and force it to be seen as a category.
-if not os.path.exists(USER):
-    os.makedirs(USER)
-
-    # Touch the CATEGORY file.
-    with open(os.path.join(USER, "CATEGORY"), "w") as catfile:
-        catfile.write("This is a placeholder file to mark this directory as a "
-                      "category, not a project.")
-
-# Create the package directory.
-if not os.path.exists(TARGET):
-    os.makedirs(TARGET)
-
+WORKSPACES = getattr(settings, "WORKSPACES", {})
+MATRIX_JOBS = getattr(settings, "MATRIX_JOBS", 2)
+# Added to package filenames, to tell apart the packages built in different
+# workspaces.
+PACKAGE_TAG = None
+if WORKSPACE is not None and "BASE" in WORKSPACES.get(WORKSPACE, {}):
+    # Every workspace builds the same projects, each into its own
+    # subdirectory of TARGET, unless it says otherwise.
+    workspace = WORKSPACES[WORKSPACE]
+    BASE = from_script(workspace["BASE"])
+    if "USER" in workspace:
+        USER = relative(workspace["USER"])
+    if "TARGET" in workspace:
+        TARGET = relative(workspace["TARGET"])
+    else:
+        TARGET = os.path.join(TARGET, WORKSPACE)
+    if "SOURCE_BUNDLE" in workspace:
+        SOURCE_BUNDLE = relative(workspace["SOURCE_BUNDLE"])
+    else:
+        SOURCE_BUNDLE = state_path(settings.SOURCE_BUNDLE)
+    PACKAGE_TAG = workspace.get("TAG", WORKSPACE)
+SANDBOXES = state_path(getattr(settings, "SANDBOXES",
+                               "mcp_rebuild/sandboxes"))
+SANDBOX_JOBS = getattr(settings, "SANDBOX_JOBS", None)
+if SANDBOX is not None:
+    # A sandbox is a copy of MCP, building the same projects into the same
+    # TARGET from the same SOURCE_BUNDLE.  Everything else, mcp_rebuild's own
+    # files included, lives in the copy.
+    BASE = os.path.join(SANDBOXES, SANDBOX)
+    state_path = relative
+RESET_MODE = getattr(settings, "RESET_MODE", "full")
+SNAPSHOT_FORMAT = getattr(settings, "SNAPSHOT_FORMAT", "bz2")
+INSTALL_MODE = getattr(settings, "INSTALL_MODE", "copy")
+BUILD_CACHE = getattr(settings, "BUILD_CACHE", None)
+if BUILD_CACHE is not None:
+    BUILD_CACHE = state_path(BUILD_CACHE)
+BUILD_CACHE_SIZE = getattr(settings, "BUILD_CACHE_SIZE", 5)
+SRG_INDEX = getattr(settings, "SRG_INDEX", None)
+if SRG_INDEX is not None:
+    SRG_INDEX = state_path(SRG_INDEX)
+BUILD_REPORT = getattr(settings, "BUILD_REPORT", None)
+if BUILD_REPORT is not None:
+    BUILD_REPORT = state_path(BUILD_REPORT)
+PACKAGE_MANIFEST = getattr(settings, "PACKAGE_MANIFEST", None)
+if PACKAGE_MANIFEST is not None:
+    PACKAGE_MANIFEST = state_path(PACKAGE_MANIFEST)
+PROJECT_CACHE = getattr(settings, "PROJECT_CACHE", None)
+if PROJECT_CACHE is not None:
+    PROJECT_CACHE = state_path(PROJECT_CACHE)
+RECOMPILE_MODE = getattr(settings, "RECOMPILE_MODE", "full")
+JAVAC = getattr(settings, "JAVAC", "javac -g -nowarn -source 1.6 -target 1.6")
+COMPILE_INDEX = state_path(getattr(settings, "COMPILE_INDEX",
+                                   "mcp_rebuild/compile.index"))
+
+def check_settings():
+    """Raises BuildFailed(UNCONFIGURED) unless settings.py is usable."""
+    if settings.UNCONFIGURED:
+        print "mcp_rebuild has not been configured properly!"
+        print "Edit config.py and try again."
+        raise BuildFailed(UNCONFIGURED)
+
+    if WORKSPACE is not None and "BASE" not in WORKSPACES.get(WORKSPACE, {}):
+        print "No workspace named %r with a BASE in settings.py." % WORKSPACE
+        print "Workspaces: %s." % (", ".join(sorted(WORKSPACES)) or "none")
+        raise BuildFailed(UNCONFIGURED)
+
+    if SANDBOX is not None and not os.path.isdir(BASE):
+        print "No sandbox named %r.  Sandboxes are made by --isolated." \
+              % SANDBOX
+        raise BuildFailed(UNCONFIGURED)
+
+    if RESET_MODE not in ("full", "manifest"):
+        print "Unknown RESET_MODE %r in settings.py." % RESET_MODE
+        print "Use \"full\" or \"manifest\"."
+        raise BuildFailed(UNCONFIGURED)
+
+    if RECOMPILE_MODE not in ("full", "incremental"):
+        print "Unknown RECOMPILE_MODE %r in settings.py." % RECOMPILE_MODE
+        print "Use \"full\" or \"incremental\"."
+        raise BuildFailed(UNCONFIGURED)
+
+    if INSTALL_MODE not in INSTALL_MODES:
+        print "Unknown INSTALL_MODE %r in settings.py." % INSTALL_MODE
+        print "Use one of: %s." % ", ".join(INSTALL_MODES)
+        raise BuildFailed(UNCONFIGURED)
+
+    if SNAPSHOT_FORMAT not in SNAPSHOT_FORMATS:
+        print "Unknown SNAPSHOT_FORMAT %r in settings.py." % SNAPSHOT_FORMAT
+        print "Use one of: %s." % ", ".join(SNAPSHOT_FORMATS)
+        raise BuildFailed(UNCONFIGURED)
 
 # MCP's src directory, the directory MCP will compile from.
 # THIS WILL BE NUKED FROM ORBIT EACH RUN.  All contents will be lost.
@@ -69,6 +239,28 @@ MCP_SRC = relative(MCP_SRC_REL)
 MCP_SRC_CLIENT = os.path.join(MCP_SRC, "minecraft")
 MCP_SRC_SERVER = os.path.join(MCP_SRC, "minecraft_server")
 
+# A record of every file and directory in the clean MCP_SRC, with the size,
+# mtime and hash of each file.  Used by the "manifest" reset mode to restore
+# only the files that differ from SOURCE_BUNDLE.
+SOURCE_MANIFEST = SOURCE_BUNDLE + ".manifest"
+# The files Project.install() wrote into MCP_SRC on the last run.  These are
+# always checked by the "manifest" reset mode, whatever their size and mtime.
+INSTALL_LOG = SOURCE_BUNDLE + ".installed"
+if SANDBOX is not None:
+    # Sandboxes share SOURCE_BUNDLE, but not what was installed in them.
+    INSTALL_LOG = relative(".mcp_rebuild.installed")
+
+# Held by whatever is changing the workspace, so that two builds can't reset
+# MCP_SRC under each other.  It's in BASE itself, so that every copy of
+# mcp_rebuild pointed at the same MCP finds the same lock.
+WORKSPACE_LOCK = relative(".mcp_rebuild.lock")
+# Builds waiting for WORKSPACE_LOCK leave their requests here, and get back the
+# result of the build that covered them.
+BUILD_QUEUE = relative(".mcp_rebuild.queue")
+# Results nobody collected (because their build was killed while it waited) are
+# cleaned up after this many seconds.
+STALE_RESULT_AGE = 24 * 60 * 60
+
 
 # MCP's bin directory, the directory MCP will obfuscate from.
 MCP_BIN = relative("bin")
@@ -82,9 +274,27 @@ MCP_REOBF = relative("reobf")
 MCP_REOBF_CLIENT = os.path.join(MCP_REOBF, "minecraft")
 MCP_REOBF_SERVER = os.path.join(MCP_REOBF, "minecraft_server")
 
+# MCP's obfuscation maps.
+MCP_SRG_CLIENT = relative(os.path.join("conf", "client.srg"))
+MCP_SRG_SERVER = relative(os.path.join("conf", "server.srg"))
+# Bump this whenever the format of SRG_INDEX changes.
+SRG_INDEX_VERSION = 1
+# Bump this whenever the format of PROJECT_CACHE changes.
+PROJECT_CACHE_VERSION = 2
+
+# MCP's configuration, which has the classpath it compiles against.
+MCP_CFG = relative(os.path.join("conf", "mcp.cfg"))
+# Bump this whenever the format of COMPILE_INDEX changes.
+COMPILE_INDEX_VERSION = 2
+
 # Detect whether the script is running under windows.
 WINDOWS = (platform.system() == "Windows")
 
+# The user's umask, for files that are made private and renamed into place.
+# It can only be read by setting it, so that's done once, now.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 # How to recompile with MCP.
 if WINDOWS:
     RECOMPILE = relative("recompile.bat")
@@ -98,11 +308,312 @@ else:
     REOBFUSCATE = relative("reobfuscate.sh")
 
 
+# This class records where a build's time goes: the wall time, files touched
+# and bytes written by each phase, and by each project.
+class BuildReport(object):
+    def __init__(self):
+        # If set, called with an event dict as each phase starts and ends.
+        self.listener = None
+        self.start()
+
+    def start(self):
+        """Forgets everything recorded, ready for a new build."""
+        self.started = time.time()
+        self.phases = []
+        self.projects = {}
+        self.exit_code = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the body of a with statement as the phase name.
+
+           The body gets a dict, where it can add to "files" and "bytes".
+        """
+        stats = {"name": name, "files": 0, "bytes": 0}
+        start = time.time()
+        if self.listener is not None:
+            self.listener({"event": "phase", "phase": name,
+                           "state": "start"})
+        try:
+            yield stats
+        finally:
+            stats["seconds"] = time.time() - start
+            self.phases.append(stats)
+            if self.listener is not None:
+                self.listener({"event": "phase", "phase": name,
+                               "state": "end", "stats": stats})
+
+    def add_project(self, name, phase, stats):
+        """Records stats for one project's part in phase."""
+        project = self.projects.setdefault(name, {})
+        totals = project.setdefault(phase, {"files": 0, "bytes": 0})
+        for (key, value) in stats.items():
+            totals[key] = totals.get(key, 0) + value
+
+    def as_dict(self):
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.localtime(self.started)),
+            "seconds": time.time() - self.started,
+            "exit_code": self.exit_code,
+            "phases": self.phases,
+            "projects": self.projects,
+        }
+
+    def save(self, filename):
+        """Writes the report to filename as JSON.
+
+           This is done as a build finishes, even if it failed, so a report
+           that can't be written only gets a warning instead of hiding what
+           went wrong with the build.
+        """
+        try:
+            with open(filename, "w") as report_file:
+                json.dump(self.as_dict(), report_file, indent=2,
+                          sort_keys=True)
+        except (IOError, OSError) as e:
+            print "WARNING: Unable to save the build report to %s: %s" \
+                  % (filename, e)
+
+# The report for the current build.
+REPORT = BuildReport()
+
+
+# How many files to copy at once when installing projects.
+COPY_THREADS = 8
+
+
+# This class collects the files every project wants to install, so that each
+# destination is written exactly once, by whichever project gets the last word.
+class InstallPlan(object):
+    def __init__(self, mode="copy"):
+        # One of INSTALL_MODES.
+        self.mode = mode
+        # Destination -> (source, project).
+        self.files = {}
+        # (destination, overridden project, overriding project), in order.
+        self.overrides = []
+        # Destinations that execute linked instead of copying.
+        self.linked = []
+
+    def add_tree(self, project, source, dest):
+        """Plans to copy everything under source into dest."""
+        for (source_dir, subdirs, files) in os.walk(source, followlinks=True):
+            dest_dir = os.path.join(dest, os.path.relpath(source_dir, source))
+            for file in files:
+                dest_file = os.path.normpath(os.path.join(dest_dir, file))
+                previous = self.files.get(dest_file)
+                if previous is not None and previous[1] is not project:
+                    self.overrides.append((dest_file, previous[1], project))
+                self.files[dest_file] = (os.path.join(source_dir, file),
+                                         project)
+
+    def report_overrides(self):
+        for (dest, overridden, overriding) in self.overrides:
+            print "%s overrides %s: %s" % (overriding.name, overridden.name,
+                                          os.path.relpath(dest, BASE))
+
+    def install_file(self, source, dest):
+        """Puts source at dest according to mode.
+
+           Returns True if dest was linked or cloned, or False if it had to be
+           copied.
+        """
+        # Never write through an existing file; it may be a link into
+        # SOURCE_BUNDLE or USER.
+        if os.path.lexists(dest):
+            os.remove(dest)
+
+        if self.mode == "hardlink":
+            return link_or_copy(source, dest)
+        elif self.mode == "symlink":
+            try:
+                os.symlink(os.path.abspath(source), dest)
+                return True
+            except (AttributeError, OSError):
+                pass # No symlinks on this platform or filesystem.
+        elif self.mode == "reflink":
+            if reflink_file(source, dest):
+                return True
+
+        try:
+            shutil.copy2(source, dest)
+        except shutil.WindowsError:
+            pass # Windows doesn't like copying access time.
+        return False
+
+    def execute(self, failcode, phase="install"):
+        """Installs every planned file.
+
+           Each project's share of the work is added to REPORT under phase.
+           Returns the total (files, bytes) installed.
+        """
+        dirs = set(os.path.dirname(dest) for dest in self.files)
+        try:
+            for dir in sorted(dirs):
+                if not os.path.isdir(dir):
+                    os.makedirs(dir)
+        except OSError as e:
+            print "Unable to create %s: %s" % (e.filename, e.strerror)
+            raise BuildFailed(failcode)
+
+        def install(item):
+            dest, (source, project) = item
+            try:
+                linked = self.install_file(source, dest)
+                return (project, os.path.getsize(dest), linked, None)
+            except (IOError, OSError) as e:
+                return (project, 0, False, "Unable to install %s from %s: %s"
+                                           % (dest, project.name, e))
+
+        pool = ThreadPool(COPY_THREADS)
+        try:
+            results = pool.map(install, self.files.items())
+        finally:
+            pool.close()
+
+        self.linked = [dest for (dest, result)
+                       in zip(self.files.keys(), results) if result[2]]
+
+        errors = [error for (project, size, linked, error) in results
+                  if error is not None]
+        if errors:
+            for error in errors:
+                print error
+            self.remove_links()
+            raise BuildFailed(failcode)
+
+        for (project, size, linked, error) in results:
+            REPORT.add_project(project.name, phase, {"files": 1,
+                                                     "bytes": size,
+                                                     "linked": int(linked)})
+
+        return len(results), sum(size for (project, size, linked, error)
+                                 in results)
+
+    def remove_links(self):
+        """Removes every hardlink or symlink execute made.
+
+           Reflinks are left, since writing to them is harmless.
+        """
+        if self.mode not in ("hardlink", "symlink"):
+            return
+        for dest in self.linked:
+            if os.path.lexists(dest):
+                os.remove(dest)
+        self.linked = []
+
+    def remove_files(self):
+        """Removes every file execute installed, linked or not."""
+        for dest in self.files:
+            if os.path.lexists(dest):
+                os.remove(dest)
+        self.linked = []
+
+
+# The compression methods a project can choose with conf/COMPRESSION.
+COMPRESSION_METHODS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED,
+}
+
+# Compressed entries bigger than this are kept on disk instead of in memory.
+SPOOL_SIZE = 1 << 20
+# prepare_packages only prepares files this small, which can't compress to
+# more than SPOOL_SIZE, so that none of them holds a temporary file open.
+PREPARE_FILE_SIZE = SPOOL_SIZE // 2
+# And stops once it's holding this much compressed data, in all.
+PREPARE_BUDGET = 64 << 20
+
+
+# Every package entry gets the same timestamp and permissions, so that the same
+# inputs always produce the same package, byte for byte.  1980 is as early as
+# zip timestamps go.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_EXTERNAL_ATTR = (stat.S_IFREG | 0644) << 16
+# Unix, whatever system built the package.
+ZIP_CREATE_SYSTEM = 3
+
+# This class holds a single file, compressed and ready to be written into a
+# package.  zipfile can't be told what compression level to use, so we do the
+# compression ourselves and hand it the finished bytes.  The file's hash_file
+# digest is worked out on the way, since it's being read anyway.
+class ZipEntry(object):
+    def __init__(self, filename, compress_type, level):
+        self.compress_type = compress_type
+
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        else:
+            compressor = None
+
+        self.data = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        crc = 0
+        size = 0
+        digest = hashlib.sha1()
+        with open(filename, "rb") as file:
+            for block in iter(lambda: file.read(1 << 16), b""):
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                digest.update(block)
+                if compressor is not None:
+                    block = compressor.compress(block)
+                self.data.write(block)
+        if compressor is not None:
+            self.data.write(compressor.flush())
+
+        self.CRC = crc & 0xffffffff
+        self.file_size = size
+        self.compress_size = self.data.tell()
+        self.digest = digest.hexdigest()
+
+    def write(self, archive, name):
+        """Adds this entry to archive (an open zipfile.ZipFile) as name.
+
+           This does what ZipFile.writestr does, minus the compression.
+        """
+        zinfo = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+        zinfo.compress_type = self.compress_type
+        zinfo.external_attr = ZIP_EXTERNAL_ATTR
+        zinfo.create_system = ZIP_CREATE_SYSTEM
+        zinfo.CRC = self.CRC
+        zinfo.file_size = self.file_size
+        zinfo.compress_size = self.compress_size
+        zinfo.header_offset = archive.fp.tell()
+        archive._writecheck(zinfo)
+        archive._didModify = True
+
+        zip64 = self.file_size > zipfile.ZIP64_LIMIT \
+                or self.compress_size > zipfile.ZIP64_LIMIT
+        archive.fp.write(zinfo.FileHeader(zip64))
+        self.data.seek(0)
+        shutil.copyfileobj(self.data, archive.fp)
+
+        archive.filelist.append(zinfo)
+        archive.NameToInfo[zinfo.filename] = zinfo
+
+    def close(self):
+        self.data.close()
+
+
 # This class is used to represent a user project, also known as a subdirectory
 # of USER.  The format is described in the README.
 class Project(object):
-    def __init__(self, directory):
+    # The files a project's conf directory may contain.
+    CONFIG_SETTINGS = ("PROJECT_NAME", "VERSION", "PACKAGE_NAME",
+                       "HIDE_SOURCE", "PACKAGE_COMMAND", "COMPRESSION",
+                       "COMPRESSION_LEVEL", "SANDBOX")
+
+    # ZipEntries made ahead of time by prepare_packages, keyed by project
+    # directory and then by filename, and their total compressed size.
+    prepared = {}
+    prepared_bytes = 0
+
+    def __init__(self, directory, config=None):
         self.dir = directory
+        if config is None:
+            config = self.read_config(directory)[0]
+        self.config = config
 
         self.name = self.get_config("PROJECT_NAME") \
                     or os.path.basename(directory)
@@ -110,71 +621,145 @@ class Project(object):
         self.package_name = self.get_config("PACKAGE_NAME")
         self.hide_source = self.get_config("HIDE_SOURCE", is_boolean=True)
         self.package_command = self.get_config("PACKAGE_COMMAND")
+        self.compression = self.get_config("COMPRESSION") or "deflated"
+        self.compression_level = self.get_config("COMPRESSION_LEVEL")
 
     def get_config(self, setting, is_boolean=False):
-        filename = os.path.join(self.dir, "conf", setting)
-        exists = os.path.isfile(filename)
+        value = self.config.get(setting)
 
         if is_boolean:
-            return exists
-        elif not exists:
-            return None
+            return value is not None
         else:
-            return open(filename).read().strip()
+            return value
+
+    @classmethod
+    def read_config(cls, directory, cached=None):
+        """Reads every setting in a project's conf directory.
+
+           Returns (config, stamp), where config maps each setting present to
+           its contents and stamp records the mtimes it was read at.  cached
+           is an earlier result for the same project, which is returned as-is
+           if nothing has changed.  Editing a file in place doesn't touch its
+           directory's mtime, so the settings' own mtimes are checked too.
+        """
+        conf = os.path.join(directory, "conf")
+        try:
+            conf_mtime = os.stat(conf).st_mtime
+        except OSError:
+            return {}, None
+
+        if cached is not None and cached[1] is not None:
+            config, (old_mtime, file_stamps) = cached
+            if old_mtime == conf_mtime:
+                for (setting, stamp) in file_stamps.items():
+                    try:
+                        stat = os.stat(os.path.join(conf, setting))
+                    except OSError:
+                        break
+                    if stamp != (stat.st_size, stat.st_mtime):
+                        break
+                else:
+                    return cached
+
+        config = {}
+        file_stamps = {}
+        for setting in set(os.listdir(conf)).intersection(cls.CONFIG_SETTINGS):
+            filename = os.path.join(conf, setting)
+            if not os.path.isfile(filename):
+                continue
+            with open(filename) as config_file:
+                config[setting] = config_file.read().strip()
+                stat = os.fstat(config_file.fileno())
+            file_stamps[setting] = (stat.st_size, stat.st_mtime)
+
+        return config, (conf_mtime, file_stamps)
 
     @classmethod
     def load_obfuscation(cls):
-        cls.client_obfuscation = cls._load_obfuscation("conf/client.srg")
-        cls.server_obfuscation = cls._load_obfuscation("conf/server.srg")
+        with REPORT.phase("srg_load"):
+            cls.srg = load_srg_index()
+        cls.client_obfuscation = cls.srg["client"]["obfuscate"]["CL"]
+        cls.server_obfuscation = cls.srg["server"]["obfuscate"]["CL"]
+        cls.client_deobfuscation = cls.srg["client"]["deobfuscate"]["CL"]
+        cls.server_deobfuscation = cls.srg["server"]["deobfuscate"]["CL"]
 
     @classmethod
     def _load_obfuscation(cls, filename):
-        obfuscation = {}
+        """Parses an SRG file.
 
-        lines = open(os.path.join(BASE, filename)).readlines()
-        for line in lines:
-            if line.startswith("CL:"):
+           Returns {"obfuscate": maps, "deobfuscate": maps}, where each maps
+           is {"CL": classes, "FD": fields, "MD": methods}.  Classes use the
+           local path separator, fields are "class/field", and methods are
+           "class/method descriptor".
+        """
+        obfuscate = {"CL": {}, "FD": {}, "MD": {}}
+
+        for line in open(filename):
+            prefix = line[:3]
+            if prefix == "CL:":
                 prefix, obfuscated, plain = line.split()
                 if os.path.sep != "/":
                     obfuscated = obfuscated.replace("/", os.path.sep)
                     plain = plain.replace("/", os.path.sep)
-                obfuscation[plain] = obfuscated
+                obfuscate["CL"][plain] = obfuscated
+            elif prefix == "FD:":
+                prefix, obfuscated, plain = line.split()
+                obfuscate["FD"][plain] = obfuscated
+            elif prefix == "MD:":
+                prefix, obfuscated, obfuscated_desc, plain, plain_desc \
+                    = line.split()
+                obfuscate["MD"]["%s %s" % (plain, plain_desc)] \
+                    = "%s %s" % (obfuscated, obfuscated_desc)
 
-        return obfuscation
+        deobfuscate = {}
+        for (kind, names) in obfuscate.items():
+            deobfuscate[kind] = dict((obfuscated, plain)
+                                     for (plain, obfuscated) in names.items())
 
-    @staticmethod
-    def collect_projects(root, projects):
-        """Collects all the active projects under root into projects."""
-        for (dir, subdirs, files) in os.walk(root, followlinks=True):
-            if "DISABLED" in files:
-                # This project or category has been disabled.  Skip it.
-                del subdirs[:]
-                print "Disabled project or category at %s." % dir
-            elif "CATEGORY" in files:
-                # This is a category, not a project.  Continue normally.
-                pass
-                print "Found category at %s, recursing." % dir
-            else:
-                # This is a project.  Create it, but do not continue into
-                # subdirectories.
-                projects.append(Project(dir))
-                del subdirs[:]
-                print "Found project at %s." % dir
+        return {"obfuscate": obfuscate, "deobfuscate": deobfuscate}
 
-    def copy_files(self, source, dest, failcode):
-        for (source_dir, subdirs, files) in os.walk(source, followlinks=True):
-            dest_dir = os.path.join(dest, os.path.relpath(source_dir, source))
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
+    @classmethod
+    def index_reobf(cls):
+        """Scans MCP's reobfuscated output for every class it produced."""
+        with REPORT.phase("index_reobf") as stats:
+            cls.client_classes = index_classes(MCP_REOBF_CLIENT)
+            cls.server_classes = index_classes(MCP_REOBF_SERVER)
+            stats["files"] = sum(len(files) for index in (cls.client_classes,
+                                                         cls.server_classes)
+                                 for files in index.values())
 
-            for file in files:
-                try:
-                    shutil.copy2(os.path.join(source_dir, file), dest_dir)
-                except shutil.WindowsError:
-                    pass # Windows doesn't like copying access time.
+    @staticmethod
+    def collect_projects(root, projects, cache=None):
+        """Collects all the active projects under root into projects.
 
-    def install(self):
-        """Installs this project into MCP's source."""
+           cache is a ProjectCache, which lets directories that haven't
+           changed since the last run be skipped over.
+        """
+        if cache is None:
+            cache = ProjectCache()
+
+        entry = cache.scan(root)
+        if entry is None:
+            return # Vanished since its parent was listed.
+        elif entry["kind"] == "disabled":
+            # This project or category has been disabled.  Skip it.
+            print "Disabled project or category at %s." % root
+        elif entry["kind"] == "category":
+            # This is a category, not a project.  Continue normally.
+            print "Found category at %s, recursing." % root
+            for subdir in entry["subdirs"]:
+                Project.collect_projects(os.path.join(root, subdir),
+                                         projects, cache)
+        else:
+            # This is a project.  Create it, but do not continue into
+            # subdirectories.
+            projects.append(Project(root, entry["config"][0]))
+            print "Found project at %s." % root
+
+    def plan_install(self, plan):
+        """Adds this project's source to plan, for installation into MCP's
+           source.
+        """
         did_something = False
 
         src = os.path.join(self.dir, "src")
@@ -182,26 +767,27 @@ class Project(object):
             # Common code into both sides first, so it can be overridden.
             common = os.path.join(src, "common")
             if os.path.isdir(common) and os.listdir(common):
-                self.copy_files(common, MCP_SRC_CLIENT, SRC_INSTALL_FAILED)
-                self.copy_files(common, MCP_SRC_SERVER, SRC_INSTALL_FAILED)
+                plan.add_tree(self, common, MCP_SRC_CLIENT)
+                plan.add_tree(self, common, MCP_SRC_SERVER)
                 did_something = True
 
             # Then client code.
             client = os.path.join(src, "client")
             if os.path.isdir(client) and os.listdir(client):
-                self.copy_files(client, MCP_SRC_CLIENT, SRC_INSTALL_FAILED)
+                plan.add_tree(self, client, MCP_SRC_CLIENT)
                 did_something = True
 
             # And finally server code.
             server = os.path.join(src, "server")
             if os.path.isdir(server) and os.listdir(server):
-                self.copy_files(server, MCP_SRC_SERVER, SRC_INSTALL_FAILED)
+                plan.add_tree(self, server, MCP_SRC_SERVER)
                 did_something = True
 
         return did_something
 
-    def install_precompiled(self):
-        """Installs this project's precompiled code into MCP's classes.
+    def plan_install_precompiled(self, plan):
+        """Adds this project's precompiled code to plan, for installation into
+           MCP's classes.
 
            This code will not be included in the project's package, as it's
            assumed to be libraries or similar code needed for reobfuscation,
@@ -218,20 +804,20 @@ class Project(object):
             # Common classes into both sides first, so it can be overridden.
             common = os.path.join(bin, "common")
             if os.path.isdir(common) and os.listdir(common):
-                self.copy_files(common, MCP_BIN_CLIENT, BIN_INSTALL_FAILED)
-                self.copy_files(common, MCP_BIN_SERVER, BIN_INSTALL_FAILED)
+                plan.add_tree(self, common, MCP_BIN_CLIENT)
+                plan.add_tree(self, common, MCP_BIN_SERVER)
                 did_something = True
 
             # Then client classes.
             client = os.path.join(bin, "client")
             if os.path.isdir(client) and os.listdir(client):
-                self.copy_files(client, MCP_BIN_CLIENT, BIN_INSTALL_FAILED)
+                plan.add_tree(self, client, MCP_BIN_CLIENT)
                 did_something = True
 
             # And finally server classes.
             server = os.path.join(bin, "server")
             if os.path.isdir(server) and os.listdir(server):
-                self.copy_files(server, MCP_BIN_SERVER, BIN_INSTALL_FAILED)
+                plan.add_tree(self, server, MCP_BIN_SERVER)
                 did_something = True
 
         return did_something
@@ -245,6 +831,9 @@ class Project(object):
             else:
                 filename = "%s" % self.name
 
+        if PACKAGE_TAG is not None:
+            filename += "-%s" % PACKAGE_TAG
+
         if server:
             filename += "-server"
 
@@ -270,12 +859,15 @@ class Project(object):
     def map_to_class(cls, files, server=False):
         """Build a list of class files from the matching list of .java files.
 
-           This method does understand Minecraft's obfuscation.
+           This method does understand Minecraft's obfuscation, and includes
+           the inner classes found by index_reobf.
         """
         if server:
             obfuscation = cls.server_obfuscation
+            index = cls.server_classes
         else:
             obfuscation = cls.client_obfuscation
+            index = cls.client_classes
 
         classes = []
         for file in files:
@@ -292,220 +884,2752 @@ class Project(object):
             prefix = os.path.join("net", "minecraft", "src", "")
             if identifier.startswith(prefix):
                 identifier = identifier[len(prefix):]
-            classes.append(identifier + ".class")
+            class_file = identifier + ".class"
+            classes += index.get(class_file, [class_file])
 
         return classes
 
-    def zip(self, archive_name, files=None, clean=False):
-        if clean:
-            mode = "w"
-        else:
-            mode = "a"
+    def get_compression(self):
+        """Returns the zipfile compression method and zlib level to use."""
+        if self.compression not in COMPRESSION_METHODS:
+            raise PackageError("Unknown compression %r in conf/COMPRESSION.  "
+                               "Use one of: %s."
+                               % (self.compression,
+                                  ", ".join(sorted(COMPRESSION_METHODS))))
 
-        with zipfile.ZipFile(archive_name, mode) as archive:
+        if self.compression_level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        else:
+            try:
+                level = int(self.compression_level)
+            except ValueError:
+                level = None
+            if level not in range(10):
+                raise PackageError("conf/COMPRESSION_LEVEL must be a number "
+                                   "from 0 to 9, not %r."
+                                   % self.compression_level)
+
+        return COMPRESSION_METHODS[self.compression], level
+
+    def collect_entries(self, layers):
+        """Lists everything that goes into a package.
+
+           layers is a list of (root, files) pairs, where files are relative to
+           root, or None for everything under root.  If several layers contain
+           the same name, the last one wins.  Returns an OrderedDict mapping
+           names in the package to the files they come from.
+        """
+        entries = collections.OrderedDict()
+        for (root, files) in layers:
             if files is None:
-                for dir, subdirs, files in os.walk(".", followlinks=True):
-                    for file in files:
-                        archive.write(os.path.join(dir, file))
-            else:
-                for file in files:
-                    archive.write(file)
-
-    def package(self):
-        """Packages this project's files."""
-        def call_or_die(cmd, shell=False):
-            exit = subprocess.call(cmd, shell=shell)
-            if exit != 0:
-                print "Command failed: %s" % cmd
-                print "Failed to package project %s.  Aborting." % project.name
-                sys.exit(PACKAGE_FAILED)
+                files = sorted(self.collect_files(root))
+            for file in files:
+                name = file.replace(os.path.sep, "/")
+                entries[name] = os.path.join(root, file)
+        return entries
 
-        if project.package_command is not None:
-            call_or_die(project.package_command, shell=True)
-            return True
-        else:
-            ## Collect and package the matching .class files for this project.
-            # Start by building a list of all of the source files of each type.
-            client_dir = os.path.join(self.dir, "src", "client")
-            client_sources = self.collect_files(client_dir)
-
-            server_dir = os.path.join(self.dir, "src", "server")
-            server_sources = self.collect_files(server_dir)
-
-            common_dir = os.path.join(self.dir, "src", "common")
-            common_sources = self.collect_files(common_dir)
-
-            # Common sources just get added to both sides.
-            client_sources.update(common_sources)
-            server_sources.update(common_sources)
-
-            # Translate the source files into their matching class files,
-            # taking obfuscation into account.
-            client_classes = self.map_to_class(client_sources)
-            server_classes = self.map_to_class(server_sources, server=True)
-
-            # Package up the client files.
-            os.chdir(MCP_REOBF_CLIENT)
-            client_package = self.get_package_file()
-            client_created = False
-            if client_classes:
-                if os.path.exists(client_package):
-                    os.remove(client_package)
-                self.zip(client_package, client_classes, clean=True)
-                client_created = True
-
-            # And then the server files.
-            os.chdir(MCP_REOBF_SERVER)
-            server_package = self.get_package_file(server=True)
-            server_created = False
-            if server_classes:
-                if os.path.exists(server_package):
-                    os.remove(server_package)
-                self.zip(server_package, server_classes, clean=True)
-                server_created = True
-
-            # If we haven't created either package yet, we won't, so bail out.
-            if not (client_created or server_created):
-                print "Nothing to package."
+    @staticmethod
+    def hash_entries(entries, compression, hashes=None):
+        """Hashes a package's inputs: its names, their contents, and how
+           they're compressed.
+
+           hashes maps filenames to their hash_file results, and is used and
+           added to if given.
+        """
+        if hashes is None:
+            hashes = {}
+        digest = hashlib.sha1(repr(compression))
+        for (name, filename) in entries.items():
+            if filename not in hashes:
+                hashes[filename] = hash_file(filename)
+            digest.update("%s\0%s\0" % (name, hashes[filename]))
+        return digest.hexdigest()
+
+    def write_package(self, archive_name, entries, compression, shared=None):
+        """Writes a package in a single pass, reproducibly.
+
+           entries is an OrderedDict from collect_entries, and compression is a
+           pair from get_compression.  They're written in sorted order to a
+           temporary file, which then replaces archive_name in one rename, so
+           nobody sees a half-written package.  If archive_name is already
+           identical, it's left alone and this returns False.
+
+           shared maps filenames that other packages also need to their
+           ZipEntry, or None until one is made.  Those entries are kept open
+           for reuse, and the caller must close them.
+        """
+        compress_type, level = compression
+        handle, temp_name = tempfile.mkstemp(
+            prefix=".", suffix=".tmp", dir=os.path.dirname(archive_name))
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                with zipfile.ZipFile(temp_file, "w",
+                                     allowZip64=True) as archive:
+                    for name in sorted(entries):
+                        filename = entries[name]
+                        if shared is not None and filename in shared:
+                            if shared[filename] is None:
+                                shared[filename] = ZipEntry(filename,
+                                                            compress_type,
+                                                            level)
+                            shared[filename].write(archive, name)
+                            continue
+
+                        entry = ZipEntry(filename, compress_type, level)
+                        try:
+                            entry.write(archive, name)
+                        finally:
+                            entry.close()
+
+            if os.path.isfile(archive_name) \
+               and filecmp.cmp(temp_name, archive_name, shallow=False):
+                os.remove(temp_name)
                 return False
 
+            # mkstemp makes files only their owner can read; give it the mode
+            # open() would have.
+            os.chmod(temp_name, 0666 & ~UMASK)
+            replace_file(temp_name, archive_name)
+            return True
+        except:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+
+    def run_package_command(self):
+        exit = run_command(self.package_command, cwd=BASE)
+        if exit != 0:
+            raise PackageError("Command failed: %s" % self.package_command)
+        return True
+
+    def plan_side(self, server=False):
+        """Works out what goes into this project's client or server package.
+
+           Returns an OrderedDict from collect_entries, which is empty if
+           there are no classes for that side.
+        """
+        if server:
+            side = "server"
+            reobf = MCP_REOBF_SERVER
+        else:
+            side = "client"
+            reobf = MCP_REOBF_CLIENT
+
+        ## Collect and package the matching .class files for this side.
+        # Common sources just get added to both sides.
+        sources = self.collect_files(os.path.join(self.dir, "src", side))
+        sources.update(self.collect_files(os.path.join(self.dir, "src",
+                                                       "common")))
+
+        # Translate the source files into their matching class files,
+        # taking obfuscation into account.
+        classes = self.map_to_class(sources, server=server)
+        if not classes:
+            return collections.OrderedDict()
+
+        layers = [(reobf, classes)] + self.file_layers(side)
+        return self.collect_entries(layers)
+
+    def file_layers(self, side):
+        """Lists the layers (see collect_entries) of resource files, then
+           source files (unless we shouldn't), for side's package.  Common
+           first, so they can be overridden.
+        """
+        kinds = ["resources"]
+        if not self.hide_source:
+            kinds.append("src")
+
+        layers = []
+        for kind in kinds:
+            for part in ("common", side):
+                root = os.path.join(self.dir, kind, part)
+                if os.path.isdir(root) and os.listdir(root):
+                    layers.append((root, None))
+        return layers
+
+    def prepare_files(self, stop):
+        """Reads, hashes and compresses this project's resource and source
+           files into Project.prepared, ready for package_sides.
+
+           Only files up to PREPARE_FILE_SIZE are prepared.  Stops early
+           (returning False) once stop, a threading.Event, is set, or once
+           Project.prepared holds PREPARE_BUDGET bytes.
+        """
+        if self.package_command is not None:
+            return True
+        try:
+            compression = self.get_compression()
+        except PackageError:
+            return True # package_sides will say so.
+
+        prepared = Project.prepared.setdefault(self.dir, {})
+        for side in ("client", "server"):
+            entries = self.collect_entries(self.file_layers(side))
+            for filename in entries.values():
+                if stop.is_set() or Project.prepared_bytes >= PREPARE_BUDGET:
+                    return False
+                if filename in prepared:
+                    continue
+                try:
+                    if os.path.getsize(filename) > PREPARE_FILE_SIZE:
+                        continue
+                    entry = ZipEntry(filename, *compression)
+                except (IOError, OSError):
+                    continue # Packaging will try again, and report it.
+                prepared[filename] = entry
+                Project.prepared_bytes += entry.compress_size
+        return True
 
-            ## Collect and package resource files.
-            # Common first, so they can be overridden.
-            common_resources = os.path.join(self.dir, "resources", "common")
-            if os.path.isdir(common_resources):
-                # To package these, we just change to the appropriate directory
-                # and let the shell and zip command find everything in it.
-                os.chdir(common_resources)
-                if client_created:
-                    self.zip(client_package)
-                if server_created:
-                    self.zip(server_package)
-
-            client_resources = os.path.join(self.dir, "resources", "client")
-            if os.path.isdir(client_resources):
-                os.chdir(client_resources)
-                if client_created:
-                    self.zip(client_package)
-
-            server_resources = os.path.join(self.dir, "resources", "server")
-            if os.path.isdir(server_resources):
-                os.chdir(server_resources)
-                if server_created:
-                    self.zip(server_package)
-
-
-            ## Collect and package source files
-            # Unless we shouldn't, in which case we're done.
-            if self.hide_source:
-                return True
+    @classmethod
+    def discard_prepared(cls):
+        """Throws away any prepared entries that weren't used."""
+        for entries in cls.prepared.values():
+            for entry in entries.values():
+                entry.close()
+        cls.prepared.clear()
+        cls.prepared_bytes = 0
+
+    def package_sides(self, previous):
+        """Builds this project's client and server packages.
+
+           previous maps package files to the records this returned for them
+           last time.  Returns (written, records), where written maps each
+           package that was written to the number of files in it, and records
+           has a record of every package's inputs, for next time.  A package
+           is left alone if its inputs haven't changed since previous, or if
+           it comes out identical to the old one.
+
+           Files that both packages need (like everything in resources/common)
+           are only read and compressed once, and files in Project.prepared
+           aren't read again at all.
+        """
+        compression = self.get_compression()
+        prepared = Project.prepared.pop(self.dir, {})
+        hashes = dict((filename, entry.digest)
+                      for (filename, entry) in prepared.items())
+        records = {}
+        todo = []
+        for server in (False, True):
+            entries = self.plan_side(server)
+            if not entries:
+                continue
+            package = self.get_package_file(server=server)
+            digest = self.hash_entries(entries, compression, hashes)
+            if os.path.exists(package) \
+               and previous.get(package) == [digest,
+                                             os.path.getsize(package)]:
+                records[package] = previous[package]
+            else:
+                todo.append((package, entries, digest))
+
+        shared = prepared
+        if len(todo) == 2:
+            client_files = set(todo[0][1].values())
+            for filename in client_files.intersection(todo[1][1].values()):
+                shared.setdefault(filename, None)
+
+        written = {}
+        try:
+            for (package, entries, digest) in todo:
+                if self.write_package(package, entries, compression, shared):
+                    written[package] = len(entries)
+                records[package] = [digest, os.path.getsize(package)]
+        finally:
+            for entry in shared.values():
+                if entry is not None:
+                    entry.close()
+
+        return written, records
+
+
+class PackageError(Exception):
+    pass
+
+class ClassFormatError(Exception):
+    pass
+
+# The sizes of the constant pool entries read_class_info skips, by tag.
+CONSTANT_SIZES = {3: 4, 4: 4, 5: 8, 6: 8, 7: 2, 8: 2, 9: 4, 10: 4, 11: 4,
+                  12: 4, 15: 3, 16: 2, 17: 4, 18: 4, 19: 2, 20: 2}
+
+# Class names inside field and method descriptors, like "Lnet/minecraft/Foo;".
+DESCRIPTOR_CLASS = re.compile(r"L([^;\[(]+);")
+
+def read_class_names(filename):
+    """Reads a class file's own name and the name of the class enclosing it.
+
+       The enclosing class comes from the EnclosingMethod attribute (for local
+       and anonymous classes) or the InnerClasses attribute (for member
+       classes), and is None for top-level classes.  Names are internal names,
+       like "net/minecraft/src/Foo$1".
+    """
+    info = read_class_info(filename)
+    return info["name"], info["outer"]
+
+def read_class_info(filename):
+    """Reads what mcp_rebuild needs to know about a class file.
+
+       Returns a dict with the class's "name" and "outer" class (see
+       read_class_names), its "source" file from the SourceFile attribute (or
+       None), and the internal names of every class it "references".
+    """
+    with open(filename, "rb") as file:
+        data = file.read()
+
+    try:
+        if data[:4] != b"\xca\xfe\xba\xbe":
+            raise ClassFormatError("not a class file")
+
+        # The constant pool.  We only need the UTF8 strings and the classes
+        # that refer to them.
+        count, = struct.unpack_from(">H", data, 8)
+        strings = {}
+        classes = {}
+        offset = 10
+        index = 1
+        while index < count:
+            tag = ord(data[offset:offset + 1])
+            offset += 1
+            if tag == 1:
+                length, = struct.unpack_from(">H", data, offset)
+                strings[index] = data[offset + 2:offset + 2 + length]
+                offset += 2 + length
+            elif tag in CONSTANT_SIZES:
+                if tag == 7:
+                    classes[index], = struct.unpack_from(">H", data, offset)
+                offset += CONSTANT_SIZES[tag]
+            else:
+                raise ClassFormatError("unknown constant tag %d" % tag)
+            # Longs and doubles take up two slots.
+            index += 2 if tag in (5, 6) else 1
+
+        class_name = lambda index: strings[classes[index]].decode("utf-8")
+
+        references = set()
+        for index in classes:
+            name = class_name(index)
+            if not name.startswith("["):
+                references.add(name)
+        for string in strings.values():
+            if b";" in string:
+                references.update(name.decode("utf-8") for name
+                                  in DESCRIPTOR_CLASS.findall(string))
+
+        this_class, = struct.unpack_from(">H", data, offset + 2)
+        interfaces, = struct.unpack_from(">H", data, offset + 6)
+        offset += 8 + 2 * interfaces
+
+        # Skip the fields and methods, which have the same layout.
+        for member_type in ("fields", "methods"):
+            members, = struct.unpack_from(">H", data, offset)
+            offset += 2
+            for member in range(members):
+                attributes, = struct.unpack_from(">H", data, offset + 6)
+                offset += 8
+                for attribute in range(attributes):
+                    length, = struct.unpack_from(">I", data, offset + 2)
+                    offset += 6 + length
+
+        outer = None
+        source = None
+        attributes, = struct.unpack_from(">H", data, offset)
+        offset += 2
+        for attribute in range(attributes):
+            name_index, length = struct.unpack_from(">HI", data, offset)
+            offset += 6
+            name = strings.get(name_index)
+            if name == b"EnclosingMethod":
+                enclosing, = struct.unpack_from(">H", data, offset)
+                outer = class_name(enclosing)
+            elif name == b"InnerClasses" and outer is None:
+                entries, = struct.unpack_from(">H", data, offset)
+                for entry in range(entries):
+                    inner_index, outer_index = \
+                        struct.unpack_from(">HH", data, offset + 2 + 8 * entry)
+                    if inner_index == this_class and outer_index != 0:
+                        outer = class_name(outer_index)
+            elif name == b"SourceFile":
+                source_index, = struct.unpack_from(">H", data, offset)
+                source = strings[source_index].decode("utf-8")
+            offset += length
+
+        name = class_name(this_class)
+        references.discard(name)
+        return {"name": name, "outer": outer, "source": source,
+                "references": references}
+    except (struct.error, KeyError, TypeError) as e:
+        raise ClassFormatError("truncated or corrupt: %s" % e)
+
+def index_classes(root):
+    """Groups the class files under root by their top-level class.
+
+       Returns a map from each top-level class file to a list of itself and
+       all of its inner, local and anonymous class files, all relative to
+       root.  Class files that can't be read are grouped by name instead, with
+       Foo$Bar.class belonging to Foo.class.
+    """
+    files = {}    # Class file -> its class's internal name.
+    outers = {}   # Internal name -> enclosing class's internal name.
+    for file in Project.collect_files(root):
+        if not file.endswith(".class"):
+            continue
+
+        try:
+            name, outer = read_class_names(os.path.join(root, file))
+        except ClassFormatError:
+            name = file[:-len(".class")].replace(os.path.sep, "/")
+            outer = name.split("$", 1)[0] if "$" in name else None
+
+        files[file] = name
+        if outer is not None:
+            outers[name] = outer
+
+    by_name = dict((name, file) for (file, name) in files.items())
+    index = {}
+    for (file, name) in files.items():
+        # Follow the chain of enclosing classes out to the top level.
+        seen = set([name])
+        while name in outers and outers[name] not in seen:
+            name = outers[name]
+            seen.add(name)
+
+        top = by_name.get(name, file)
+        index.setdefault(top, []).append(file)
+
+    for files in index.values():
+        files.sort()
+
+    return index
+
+def init_packager():
+    """Prepares a packaging worker process.
+
+       Forked workers inherit the obfuscation maps and the index of MCP's
+       reobfuscated classes, but others need to load them.
+    """
+    if not hasattr(Project, "client_obfuscation"):
+        Project.load_obfuscation()
+    if not hasattr(Project, "client_classes"):
+        Project.index_reobf()
+
+def run_package_task(task):
+    """Packages one project for package_projects.
+
+       task is a (project, previous) pair, where previous has the records of
+       project's packages from PACKAGE_MANIFEST.  Returns (created, records,
+       error, stats), where created is whether the project has any packages,
+       records are their new records, error is None on success and stats are
+       for BuildReport.  Errors are returned instead of raised so that they
+       survive the trip back from a worker process.
+    """
+    project, previous = task
+    init_packager()
+    stats = {"files": 0, "bytes": 0, "skipped": 0}
+    start = time.time()
+    records = {}
+    try:
+        if project.package_command is not None:
+            created = project.run_package_command()
+        else:
+            written, records = project.package_sides(previous)
+            created = bool(records)
+            stats["files"] = sum(written.values())
+            stats["bytes"] = sum(records[package][1] for package in written)
+            stats["skipped"] = len(records) - len(written)
+        error = None
+    except PackageError as e:
+        created, error = False, str(e)
+    except (IOError, OSError, zipfile.BadZipfile) as e:
+        created, error = False, "%s: %s" % (e.__class__.__name__, e)
+
+    stats["seconds"] = time.time() - start
+    return (created, records, error, stats)
+
+def prepare_packages(projects, stop):
+    """Gets projects' resource and source files ready for packaging (see
+       Project.prepare_files), until stop is set or the budget runs out.
+
+       Meant to run while MCP compiles, so that packaging has little left to
+       do but the class files and whatever was too big to prepare.
+    """
+    with REPORT.phase("package_prepare") as stats:
+        for project in projects:
+            if not project.prepare_files(stop):
+                break
+        for entries in Project.prepared.values():
+            stats["files"] += len(entries)
+            stats["bytes"] += sum(entry.file_size
+                                  for entry in entries.values())
+
+def load_package_manifest():
+    """Returns PACKAGE_MANIFEST's records, keyed by package file."""
+    if PACKAGE_MANIFEST is None or not os.path.exists(PACKAGE_MANIFEST):
+        return {}
+    try:
+        with open(PACKAGE_MANIFEST) as manifest_file:
+            return json.load(manifest_file)
+    except ValueError:
+        return {} # Damaged; everything will just be packaged again.
+
+def save_package_manifest(records):
+    if PACKAGE_MANIFEST is None:
+        return
+    temp_file = PACKAGE_MANIFEST + ".tmp"
+    with open(temp_file, "w") as manifest_file:
+        json.dump(records, manifest_file, indent=1, sort_keys=True)
+    replace_file(temp_file, PACKAGE_MANIFEST)
+
+def package_projects(projects, jobs):
+    """Packages projects, using up to jobs worker processes.
+
+       Packages whose inputs are unchanged since PACKAGE_MANIFEST was saved
+       are left alone.  Returns the number of projects that have at least one
+       package.
+    """
+    records = load_package_manifest()
+    tasks = []
+    for project in projects:
+        previous = {}
+        for server in (False, True):
+            package = project.get_package_file(server)
+            if package in records:
+                previous[package] = records.pop(package)
+        tasks.append((project, previous))
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)),
+                                    initializer=init_packager)
+        try:
+            results = pool.map(run_package_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run_package_task, tasks)
+
+    created = {}
+    updated = {}
+    failed = False
+    for ((project, previous), (project_created, new_records, error, stats)) \
+        in zip(tasks, results):
+        REPORT.add_project(project.name, "package", stats)
+        if error is not None:
+            print "Failed to package project %s: %s" % (project.name, error)
+            failed = True
+        records.update(new_records)
+        created[project] = project_created
+        updated[project] = stats["files"] > 0 or (project_created
+                                                  and not new_records)
+
+    # Even if something failed, remember the packages that were written.
+    save_package_manifest(records)
+
+    if failed:
+        print "Aborting."
+        raise BuildFailed(PACKAGE_FAILED)
 
-            # Common first, so they can be overridden.
-            common_source = os.path.join(self.dir, "src", "common")
-            if os.path.isdir(common_source) and os.listdir(common_source):
-                # To package these, we just change to the appropriate directory
-                # and let the shell and zip command find everything in it.
-                os.chdir(common_source)
-                if client_created:
-                    self.zip(client_package)
-                if server_created:
-                    self.zip(server_package)
-
-            client_source = os.path.join(self.dir, "src", "client")
-            if os.path.isdir(client_source) and os.listdir(client_source):
-                os.chdir(client_source)
-                if client_created:
-                    self.zip(client_package)
-
-            server_source = os.path.join(self.dir, "src", "server")
-            if os.path.isdir(server_source) and os.listdir(server_source):
-                os.chdir(server_source)
-                if server_created:
-                    self.zip(server_package)
+    for project in projects:
+        if updated[project]:
+            print "Packaged %s." % project.name
+        elif created[project]:
+            print "%s is unchanged." % project.name
+        else:
+            print "Nothing to package for %s." % project.name
+
+    return sum(1 for project in projects if created[project])
+
+
+# Helpers for resetting MCP's source directory.
+def bundle_name(path):
+    """Returns the name path has (or would have) inside SOURCE_BUNDLE."""
+    return os.path.relpath(path, BASE).replace(os.path.sep, "/")
+
+def hash_file(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def bundle_stamp():
+    """Identifies the current SOURCE_BUNDLE, so stale manifests are noticed."""
+    stat = os.stat(SOURCE_BUNDLE)
+    return [stat.st_size, int(stat.st_mtime)]
+
+def build_manifest():
+    """Records the contents of a clean MCP_SRC."""
+    files = {}
+    dirs = []
+    for (dir, subdirs, filenames) in os.walk(MCP_SRC):
+        dirs.append(bundle_name(dir))
+        for filename in filenames:
+            full_name = os.path.join(dir, filename)
+            stat = os.stat(full_name)
+            files[bundle_name(full_name)] = [stat.st_size, int(stat.st_mtime),
+                                             hash_file(full_name)]
+
+    return {"bundle": bundle_stamp(), "files": files, "dirs": dirs}
+
+def save_manifest():
+    print "Recording source manifest..."
+    # Sandboxes built side by side share SOURCE_MANIFEST, so it's written all
+    # at once.
+    write_json(SOURCE_MANIFEST, build_manifest())
+
+def load_manifest():
+    """Loads the source manifest, or None if it is missing or out of date."""
+    if not os.path.isfile(SOURCE_MANIFEST):
+        return None
+
+    try:
+        with open(SOURCE_MANIFEST) as manifest_file:
+            manifest = json.load(manifest_file)
+    except ValueError:
+        return None
+
+    if manifest.get("bundle") != bundle_stamp():
+        return None
+
+    return manifest
+
+def load_install_log():
+    """Returns the set of files installed last run, or None if unknown."""
+    if not os.path.isfile(INSTALL_LOG):
+        return None
+
+    with open(INSTALL_LOG) as log:
+        return set(json.load(log))
+
+def save_install_log(installed):
+    with open(INSTALL_LOG, "w") as log:
+        json.dump(sorted(set(bundle_name(file) for file in installed)), log)
+
+def find_dirty_files(manifest, installed):
+    """Compares MCP_SRC against the manifest.
+
+       Returns the bundle names that need to be restored, along with the
+       absolute paths of the files and directories that need to be removed.
+
+       Files whose size and mtime match the manifest are assumed to be clean,
+       unless installed says that a project wrote them.  If installed is None,
+       every file is hashed.
+    """
+    files = manifest["files"]
+    dirs = set(manifest["dirs"])
+
+    dirty = set()
+    extra_files = []
+    extra_dirs = []
+    seen = set()
+    for (dir, subdirs, filenames) in os.walk(MCP_SRC):
+        if bundle_name(dir) in dirs:
+            seen.add(bundle_name(dir))
+        else:
+            extra_dirs.append(dir)
 
-            return True
+        for filename in filenames:
+            full_name = os.path.join(dir, filename)
+            name = bundle_name(full_name)
+            if name not in files:
+                extra_files.append(full_name)
+                continue
 
+            seen.add(name)
+            size, mtime, digest = files[name]
+            stat = os.stat(full_name)
+            if stat.st_size != size:
+                dirty.add(name)
+            elif installed is None or name in installed \
+                 or int(stat.st_mtime) != mtime:
+                if hash_file(full_name) != digest:
+                    dirty.add(name)
+
+    dirty.update(set(files) - seen)
+    dirty.update(dirs - seen)
+
+    return dirty, extra_files, extra_dirs
+
+def link_or_copy(source, dest):
+    """Hardlinks source to dest, copying instead if that's not possible.
+
+       Returns True if dest is a link.
+    """
+    try:
+        os.link(source, dest)
+        return True
+    except (AttributeError, OSError):
+        shutil.copy2(source, dest)
+        return False
+
+# The Linux ioctl that makes one file share another's data, copy-on-write.
+FICLONE = 0x40049409
+
+def reflink_file(source, dest):
+    """Clones source to dest, so they share data until either is written.
+
+       Returns False, leaving nothing at dest, if the platform or filesystem
+       can't do that.
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    with open(source, "rb") as source_file:
+        with open(dest, "wb") as dest_file:
+            try:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+                cloned = True
+            except IOError:
+                cloned = False
+
+    if not cloned:
+        os.remove(dest)
+        return False
+    shutil.copystat(source, dest)
+    return True
+
+def make_read_only(root):
+    """Removes write permission from every file under root.
+
+       Used on hardlink farms, so that writing through a link fails instead of
+       silently changing the farm.  Windows can't remove read-only files
+       without extra work, so it's skipped there.
+    """
+    if WINDOWS:
+        return
+
+    for (dir, subdirs, files) in os.walk(root):
+        for file in files:
+            full_name = os.path.join(dir, file)
+            mode = os.stat(full_name).st_mode
+            os.chmod(full_name, mode & ~(stat.S_IWUSR | stat.S_IWGRP
+                                         | stat.S_IWOTH))
+
+def detect_snapshot_format(filename):
+    """Works out how an existing snapshot is stored."""
+    if os.path.isdir(filename):
+        return "links"
+
+    with open(filename, "rb") as file:
+        magic = file.read(6)
+
+    if magic.startswith(b"BZh"):
+        return "bz2"
+    elif magic.startswith(b"\x1f\x8b"):
+        return "gz"
+    elif magic.startswith(b"\xfd7zXZ\x00"):
+        return "xz"
+    else:
+        return "tar"
+
+@contextlib.contextmanager
+def open_tarball(filename, format, mode):
+    """Opens a tarball snapshot for reading ("r") or writing ("w").
+
+       Older Pythons have no xz support in tarfile, so xz snapshots are piped
+       through the xz command instead.  The resulting archive is a stream, so
+       it must be read in order.
+    """
+    if format != "xz" or "xz" in tarfile.TarFile.OPEN_METH:
+        compression = "" if format == "tar" else format
+        with tarfile.open(filename, "%s:%s" % (mode, compression)) as archive:
+            yield archive
+        return
+
+    try:
+        if mode == "r":
+            process = subprocess.Popen(["xz", "-dc", filename],
+                                       stdout=subprocess.PIPE)
+            stream = process.stdout
+        else:
+            with open(filename, "wb") as output:
+                process = subprocess.Popen(["xz", "-c"],
+                                           stdin=subprocess.PIPE,
+                                           stdout=output)
+            stream = process.stdin
+    except OSError:
+        print "This Python can't handle xz snapshots, and the xz command is"
+        print "not available.  Choose another SNAPSHOT_FORMAT."
+        raise BuildFailed(BAD_BUNDLE)
+
+    try:
+        with tarfile.open(fileobj=stream, mode=mode + "|") as archive:
+            yield archive
+    finally:
+        stream.close()
+        if process.wait() != 0:
+            print "xz failed on %s." % filename
+            raise BuildFailed(BAD_BUNDLE)
+
+def create_snapshot(filename, format):
+    """Snapshots MCP_SRC into filename, stored as format."""
+    if format == "links":
+        shutil.copytree(MCP_SRC, os.path.join(filename, MCP_SRC_REL))
+        make_read_only(filename)
+    else:
+        with open_tarball(filename, format, "w") as archive:
+            archive.add(MCP_SRC, arcname=MCP_SRC_REL)
+
+def restore_bundle(names=None):
+    """Restores SOURCE_BUNDLE into BASE.
+
+       If names is given, only those entries are restored, replacing any
+       existing copies.  Returns the number of files and bytes restored.
+    """
+    restored = 0
+    bytes = 0
+    format = detect_snapshot_format(SOURCE_BUNDLE)
+    if format == "links":
+        for (dir, subdirs, files) in os.walk(SOURCE_BUNDLE):
+            dest_dir = os.path.join(BASE, os.path.relpath(dir, SOURCE_BUNDLE))
+            name = bundle_name(dest_dir)
+            if names is None or name in names:
+                if not os.path.isdir(dest_dir):
+                    os.makedirs(dest_dir)
 
-print "STEP 1: Cleaning MCP's source directory."
-if not os.path.exists(SOURCE_BUNDLE):
-    # We want this without a newline at the end, and print doesn't want to do
-    # that, even with a trailing comma.  *shrug*
-    sys.stdout.write("Source bundle not found.  Is MCP's source directory clean? (y/N) ")
-    answer = sys.stdin.readline().lower()
-    if answer.startswith("y"):
-        print "Creating source bundle..."
-        with tarfile.open(SOURCE_BUNDLE, "w:bz2") as archive:
-            archive.add(MCP_SRC_REL)
-        print "Bundle created.  No need to clean the source directory."
+            for file in files:
+                dest = os.path.join(dest_dir, file)
+                if names is not None:
+                    if bundle_name(dest) not in names:
+                        continue
+                    if not os.path.isdir(dest_dir):
+                        os.makedirs(dest_dir)
+                    if os.path.lexists(dest):
+                        os.remove(dest)
+                link_or_copy(os.path.join(dir, file), dest)
+                restored += 1
+                bytes += os.path.getsize(dest)
+        return restored, bytes
+
+    with open_tarball(SOURCE_BUNDLE, format, "r") as archive:
+        for member in archive:
+            if names is None or member.name in names:
+                target = os.path.join(BASE, member.name)
+                if names is not None and (os.path.isfile(target)
+                                          or os.path.islink(target)):
+                    os.remove(target)
+                archive.extract(member, BASE)
+                if member.isfile():
+                    restored += 1
+                    bytes += member.size
+
+    return restored, bytes
+
+def convert_bundle(format):
+    """Rewrites SOURCE_BUNDLE in a different format, keeping its contents."""
+    if not os.path.exists(SOURCE_BUNDLE):
+        print "Source bundle not found; nothing to convert."
+        raise BuildFailed(BUNDLE_MISSING)
+
+    current = detect_snapshot_format(SOURCE_BUNDLE)
+    if current == format:
+        print "Source bundle is already stored as %s." % format
+        return
+
+    print "Converting source bundle from %s to %s..." % (current, format)
+    manifest = load_manifest()
+    new_bundle = SOURCE_BUNDLE + ".new"
+    if current == "links":
+        with open_tarball(new_bundle, format, "w") as archive:
+            archive.add(os.path.join(SOURCE_BUNDLE, MCP_SRC_REL),
+                        arcname=MCP_SRC_REL)
+    elif format == "links":
+        os.makedirs(new_bundle)
+        with open_tarball(SOURCE_BUNDLE, current, "r") as archive:
+            archive.extractall(new_bundle)
+        make_read_only(new_bundle)
     else:
-        print "Clean MCP's source directory and run this script again."
-        sys.exit(BUNDLE_MISSING)
-else:
-    if os.path.exists(MCP_SRC):
+        with open_tarball(SOURCE_BUNDLE, current, "r") as source:
+            with open_tarball(new_bundle, format, "w") as archive:
+                for member in source:
+                    if member.isfile():
+                        archive.addfile(member, source.extractfile(member))
+                    else:
+                        archive.addfile(member)
+
+    if current == "links":
+        shutil.rmtree(SOURCE_BUNDLE)
+    else:
+        os.remove(SOURCE_BUNDLE)
+    os.rename(new_bundle, SOURCE_BUNDLE)
+
+    # The contents haven't changed, so an up-to-date manifest still is.
+    if manifest is not None:
+        manifest["bundle"] = bundle_stamp()
+        with open(SOURCE_MANIFEST, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+    print "Source bundle converted.  Set SNAPSHOT_FORMAT = %r in settings.py" \
+          % format
+    print "to keep new bundles in this format."
+
+def reset_changed(manifest):
+    """Resets MCP_SRC by restoring only the files that differ from the bundle.
+
+       Returns the number of files touched and bytes restored.
+    """
+    print "Checking MCP's source directory against the manifest..."
+    dirty, extra_files, extra_dirs = find_dirty_files(manifest,
+                                                      load_install_log())
+
+    if not (dirty or extra_files or extra_dirs):
+        print "MCP's source directory is already clean."
+        return 0, 0
+
+    for file in extra_files:
+        os.remove(file)
+    # Deepest first, so that parents are empty by the time we reach them.
+    for dir in sorted(extra_dirs, reverse=True):
+        try:
+            os.rmdir(dir)
+        except OSError:
+            pass # Not empty; leave it alone.
+
+    files, bytes = 0, 0
+    if dirty:
+        files, bytes = restore_bundle(dirty)
+
+    print "Removed %d file(s) and restored %d file(s) from the bundle." \
+          % (len(extra_files), len(dirty))
+    return len(extra_files) + files, bytes
+
+def reset_full(confirm=True, ask=None):
+    """Deletes MCP_SRC and restores the whole bundle.
+
+       Unless confirm is False, ask (ask_user by default) is asked first.
+       Returns the number of files and bytes restored.
+    """
+    if os.path.exists(MCP_SRC) and not confirm:
+        shutil.rmtree(MCP_SRC)
+    elif os.path.exists(MCP_SRC):
         print "Nuking MCP's source directory from orbit..."
         print "Please confirm that this path is correct.  All contents will be"
         print "destroyed and a clean version will be restored from the bundle:"
         print MCP_SRC
-        # We want this without a newline at the end, and print doesn't want to
-        # do that, even with a trailing comma.  *shrug*
-        sys.stdout.write("Are you sure it's safe to delete this directory and its contents? (y/N) ")
-        answer = sys.stdin.readline().lower()
-        if not answer.startswith("y"):
+        if not (ask or ask_user)("Are you sure it's safe to delete this directory and its contents?"):
             print "Unable to safely clean MCP's source directory.  Aborting."
-            sys.exit(UNSAFE_DELETE)
+            raise BuildFailed(UNSAFE_DELETE)
         shutil.rmtree(MCP_SRC)
     else:
         print "MCP's source directory is missing; no need to delete it."
     print "Restoring source bundle..."
-    with tarfile.open(SOURCE_BUNDLE, "r:bz2") as archive:
-        archive.extractall()
+    restored = restore_bundle()
     print "Bundle restored; MCP's source directory is now clean."
+    return restored
+
+
+# Helpers for SRG_INDEX, which keeps the parsed obfuscation maps on disk.
+def replace_file(source, dest):
+    """Renames source over dest, even on Windows."""
+    try:
+        os.rename(source, dest)
+    except OSError:
+        if not os.path.exists(dest):
+            raise
+        os.remove(dest)
+        os.rename(source, dest)
+
+def load_srg_index():
+    """Returns the parsed SRG files, keyed by "client" and "server".
+
+       Each side is parsed by Project._load_obfuscation, then stored in
+       SRG_INDEX with the size, mtime and hash of its SRG file.  A side is only
+       parsed again if its SRG file's contents change.
+    """
+    index = None
+    if SRG_INDEX is not None and os.path.isfile(SRG_INDEX):
+        try:
+            with open(SRG_INDEX, "rb") as index_file:
+                index = marshal.load(index_file)
+        except (EOFError, ValueError, TypeError):
+            pass # Corrupt; rebuild it.
+
+    if not isinstance(index, dict) \
+       or index.get("version") != SRG_INDEX_VERSION:
+        index = {"version": SRG_INDEX_VERSION}
+
+    changed = False
+    for (side, filename) in (("client", MCP_SRG_CLIENT),
+                             ("server", MCP_SRG_SERVER)):
+        stat = os.stat(filename)
+        stamp = [stat.st_size, stat.st_mtime]
+        entry = index.get(side)
+        if entry is not None and entry["stamp"] == stamp:
+            continue
+
+        digest = hash_file(filename)
+        if entry is None or entry["hash"] != digest:
+            print "Indexing %s..." % os.path.relpath(filename, BASE)
+            entry = Project._load_obfuscation(filename)
+            entry["hash"] = digest
+            index[side] = entry
+        entry["stamp"] = stamp
+        changed = True
+
+    if changed and SRG_INDEX is not None:
+        temp = SRG_INDEX + ".tmp"
+        with open(temp, "wb") as index_file:
+            marshal.dump(index, index_file)
+        replace_file(temp, SRG_INDEX)
+
+    return index
+
+
+# This class keeps PROJECT_CACHE, which records what each directory under USER
+# turned out to be, along with each project's config.  A directory is only
+# listed again if its mtime changes.
+class ProjectCache(object):
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.old = {}
+        if filename is not None and os.path.isfile(filename):
+            try:
+                with open(filename, "rb") as cache_file:
+                    cache = marshal.load(cache_file)
+                if cache.get("version") == PROJECT_CACHE_VERSION:
+                    self.old = cache["dirs"]
+            except (EOFError, ValueError, TypeError, AttributeError, KeyError):
+                pass # Corrupt; start over.
+        # Only directories seen this run are kept, so removed ones drop out.
+        self.dirs = {}
+
+    def scan(self, directory):
+        """Returns what directory is, listing it only if it has changed.
+
+           The result is a dict whose "kind" is "disabled", "category" (with
+           its "subdirs") or "project" (with its "config" from
+           Project.read_config), or None if the directory is gone.
+        """
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return None
+
+        old = self.old.get(directory)
+        if old is not None and old["mtime"] == mtime:
+            entry = dict(old)
+        else:
+            names = os.listdir(directory)
+            markers = set(name for name in ("DISABLED", "CATEGORY")
+                          if name in names and not
+                             os.path.isdir(os.path.join(directory, name)))
+            entry = {"mtime": mtime}
+            if "DISABLED" in markers:
+                entry["kind"] = "disabled"
+            elif "CATEGORY" in markers:
+                entry["kind"] = "category"
+                entry["subdirs"] = [name for name in names if os.path.isdir(
+                                        os.path.join(directory, name))]
+            else:
+                entry["kind"] = "project"
+
+        if entry["kind"] == "project":
+            # conf/ has its own mtime, so check it even if directory hasn't
+            # changed.
+            cached = None
+            if old is not None:
+                cached = old.get("config")
+            entry["config"] = Project.read_config(directory, cached)
+
+        self.dirs[directory] = entry
+        return entry
+
+    def save(self):
+        """Writes the cache back out, if anything changed."""
+        if self.filename is None or self.dirs == self.old:
+            return
+        temp = self.filename + ".tmp"
+        with open(temp, "wb") as cache_file:
+            marshal.dump({"version": PROJECT_CACHE_VERSION,
+                          "dirs": self.dirs}, cache_file)
+        replace_file(temp, self.filename)
+
+
+# Helpers for the build cache, which stores MCP's reobfuscated output keyed by
+# a hash of everything that went into it.
+def update_digest(digest, *values):
+    for value in values:
+        if not isinstance(value, bytes):
+            value = unicode(value).encode("utf-8")
+        digest.update(value + b"\0")
+
+def build_cache_key(plans, manifest=None):
+    """Hashes every input to recompiling and reobfuscating.
+
+       That's the clean source (via its manifest, if there is one), the files
+       in each of plans, MCP's obfuscation maps and MCP's own scripts.
+    """
+    digest = hashlib.sha1()
+
+    if manifest is None:
+        manifest = load_manifest()
+    if manifest is not None:
+        update_digest(digest, "manifest",
+                      json.dumps(manifest["files"], sort_keys=True))
+    else:
+        update_digest(digest, "bundle", *bundle_stamp())
+
+    for (label, plan) in plans:
+        for dest in sorted(plan.files):
+            source, project = plan.files[dest]
+            update_digest(digest, label, os.path.relpath(dest, BASE),
+                          hash_file(source))
+
+    for filename in (MCP_SRG_CLIENT, MCP_SRG_SERVER, RECOMPILE, REOBFUSCATE):
+        if os.path.isfile(filename):
+            update_digest(digest, os.path.relpath(filename, BASE),
+                          hash_file(filename))
+
+    return digest.hexdigest()
+
+def restore_cached_build(key):
+    """Replaces MCP_REOBF with the cached copy for key, if there is one."""
+    cached = os.path.join(BUILD_CACHE, key)
+    if not os.path.isdir(cached):
+        return False
+
+    if os.path.exists(MCP_REOBF):
+        shutil.rmtree(MCP_REOBF)
+    shutil.copytree(cached, MCP_REOBF)
+
+    # Mark it as recently used, so it's the last to be evicted.
+    os.utime(cached, None)
+    return True
+
+def store_cached_build(key):
+    """Copies MCP_REOBF into the cache under key, evicting old entries."""
+    if not os.path.isdir(BUILD_CACHE):
+        os.makedirs(BUILD_CACHE)
+
+    cached = os.path.join(BUILD_CACHE, key)
+    if os.path.isdir(cached):
+        return
+
+    # Copy under a temporary name first, so a half-written entry is never
+    # mistaken for a good one.
+    temp = cached + ".tmp"
+    if os.path.exists(temp):
+        shutil.rmtree(temp)
+    shutil.copytree(MCP_REOBF, temp)
+    os.rename(temp, cached)
+
+    entries = [os.path.join(BUILD_CACHE, entry)
+               for entry in os.listdir(BUILD_CACHE)
+               if not entry.endswith(".tmp")]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for old in entries[BUILD_CACHE_SIZE:]:
+        shutil.rmtree(old)
+
+
+# Helpers for RECOMPILE_MODE = "incremental", which keeps MCP_BIN between runs
+# and uses COMPILE_INDEX to work out what needs compiling again.  The index
+# records the project sources compiled last time, and for each class file in
+# MCP_BIN, the source it came from and the classes it references.
+COMPILE_SIDES = (("client", MCP_SRC_CLIENT, MCP_BIN_CLIENT),
+                 ("server", MCP_SRC_SERVER, MCP_BIN_SERVER))
+
+def read_mcp_classpath():
+    """Returns MCP's classpath for each side, from MCP_CFG.
+
+       Returns None if MCP_CFG doesn't have one, as in some versions of MCP.
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read(MCP_CFG):
+        return None
+
+    classpath = {}
+    try:
+        for (side, option) in (("client", "ClassPathClient"),
+                               ("server", "ClassPathServer")):
+            paths = config.get("RECOMPILE", option).split(",")
+            classpath[side] = [relative(path.strip()) for path in paths
+                               if path.strip()]
+    except ConfigParser.Error:
+        return None
+    return classpath
+
+def hash_installed_sources(plan):
+    """Hashes the .java files plan installs, by destination."""
+    return dict((dest, hash_file(source))
+                for (dest, (source, project)) in plan.files.items()
+                if dest.endswith(".java"))
+
+def index_class_files(root, files):
+    """Reads class files (relative to root) for COMPILE_INDEX.
+
+       Returns {class file: (source, references)}, where source is the .java
+       file it was compiled from, relative to the source directory.
+    """
+    classes = {}
+    for file in files:
+        try:
+            info = read_class_info(os.path.join(root, file))
+        except (ClassFormatError, IOError):
+            continue # Not something javac wrote.
+        source = info["source"]
+        if source is None:
+            source = info["name"].rsplit("/", 1)[-1].split("$")[0] + ".java"
+        classes[file] = (os.path.join(os.path.dirname(file), source),
+                         sorted(info["references"]))
+    return classes
+
+def build_compile_index(plan, classpath):
+    """Indexes MCP_BIN after a full recompile of plan's sources."""
+    index = {"version": COMPILE_INDEX_VERSION, "bundle": bundle_stamp(),
+             "javac": JAVAC, "classpath": classpath,
+             "installed": hash_installed_sources(plan), "sides": {}}
+    for (side, src_dir, bin_dir) in COMPILE_SIDES:
+        files = [file for file in Project.collect_files(bin_dir)
+                 if file.endswith(".class")]
+        index["sides"][side] = index_class_files(bin_dir, files)
+    return index
+
+def load_compile_index():
+    if not os.path.isfile(COMPILE_INDEX):
+        return None
+    try:
+        with open(COMPILE_INDEX, "rb") as index_file:
+            index = marshal.load(index_file)
+    except (EOFError, ValueError, TypeError):
+        return None # Corrupt.
+    if not isinstance(index, dict) \
+       or index.get("version") != COMPILE_INDEX_VERSION:
+        return None
+    return index
+
+def save_compile_index(index):
+    temp = COMPILE_INDEX + ".tmp"
+    with open(temp, "wb") as index_file:
+        marshal.dump(index, index_file)
+    replace_file(temp, COMPILE_INDEX)
+
+def find_program(program):
+    """Returns the file a command starting with program would run, or None.
+
+       Like the commands themselves, relative paths are taken from BASE.
+    """
+    if os.path.dirname(program):
+        dirs = [BASE]
+    else:
+        dirs = os.environ.get("PATH", "").split(os.pathsep)
+    extensions = [""]
+    if WINDOWS:
+        extensions += os.environ.get("PATHEXT", ".EXE").split(os.pathsep)
+
+    for dir in dirs:
+        for extension in extensions:
+            path = os.path.join(dir, program + extension)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+def run_javac(src_dir, bin_dir, classpath, sources):
+    """Compiles sources (relative to src_dir) into bin_dir with JAVAC.
+
+       Returns True if it worked.
+    """
+    # The list of sources can be too long for a command line, so javac reads
+    # it from a file.
+    handle, list_name = tempfile.mkstemp(suffix=".txt")
+    try:
+        with os.fdopen(handle, "w") as list_file:
+            for source in sources:
+                path = os.path.join(src_dir, source).replace(os.path.sep, "/")
+                list_file.write('"%s"\n' % path)
+
+        command = shlex.split(JAVAC) + [
+            "-implicit:none", "-d", bin_dir,
+            "-classpath", os.pathsep.join([bin_dir] + classpath),
+            "@" + list_name]
+        try:
+            return run_command(command, cwd=BASE) == 0
+        except OSError as e:
+            print "Unable to run %s: %s" % (command[0], e)
+            return False
+    finally:
+        os.remove(list_name)
+
+def compile_incremental(plan, stats):
+    """Compiles just the sources that changed since COMPILE_INDEX was saved.
+
+       Every class that references a class from a changed source is compiled
+       again too, so that changes which break it are caught, and so is every
+       class that has gone missing from MCP_BIN (such as those replaced by
+       precompiled files, which are removed after each build).  Returns False
+       if a full recompile is needed instead: when there's no usable index,
+       or javac fails.  stats is a REPORT phase's dict.
+    """
+    classpath = read_mcp_classpath()
+    if classpath is None:
+        print "No classpath in %s; doing a full recompile." \
+              % os.path.relpath(MCP_CFG, BASE)
+        return False
+
+    index = load_compile_index()
+    if index is None or index["bundle"] != bundle_stamp() \
+       or index["javac"] != JAVAC or index["classpath"] != classpath:
+        print "No up-to-date compile index; doing a full recompile."
+        return False
+
+    javac = shlex.split(JAVAC)
+    if not javac or find_program(javac[0]) is None:
+        print "Can't find JAVAC (%s); doing a full recompile." % JAVAC
+        return False
+
+    installed = hash_installed_sources(plan)
+    previous = index["installed"]
+    changed = set(dest for dest in set(installed) | set(previous)
+                  if installed.get(dest) != previous.get(dest))
+
+    # MCP_BIN is about to stop matching the index, so forget it until it's
+    # been brought up to date.
+    os.remove(COMPILE_INDEX)
+
+    for (side, src_dir, bin_dir) in COMPILE_SIDES:
+        classes = index["sides"][side]
+        sources = set(os.path.relpath(dest, src_dir) for dest in changed
+                      if dest.startswith(os.path.join(src_dir, "")))
+        missing = set(source for (file, (source, references))
+                      in classes.items()
+                      if not os.path.isfile(os.path.join(bin_dir, file)))
+        if not (sources or missing):
+            continue
+
+        by_source = {}
+        for (file, (source, references)) in classes.items():
+            by_source.setdefault(source, []).append(file)
+
+        changed_classes = set(file[:-len(".class")].replace(os.path.sep, "/")
+                              for source in sources
+                              for file in by_source.get(source, []))
+        for (file, (source, references)) in classes.items():
+            if changed_classes.intersection(references):
+                sources.add(source)
+        sources.update(missing)
+
+        # Remove the old classes first, so that none are left behind by
+        # sources that were deleted or no longer declare them.
+        for source in sources:
+            for file in by_source.get(source, []):
+                if os.path.lexists(os.path.join(bin_dir, file)):
+                    os.remove(os.path.join(bin_dir, file))
+                del classes[file]
+
+        sources = sorted(source for source in sources
+                         if os.path.isfile(os.path.join(src_dir, source)))
+        if not sources:
+            continue
+
+        print "Compiling %d %s file(s)." % (len(sources), side)
+        # Some filesystems only keep mtimes to the nearest 2 seconds.
+        start = time.time() - 2
+        if not run_javac(src_dir, bin_dir, classpath[side], sources):
+            print "Incremental compile failed; doing a full recompile."
+            return False
+        stats["files"] += len(sources)
+
+        written = [file for file in Project.collect_files(bin_dir)
+                   if file.endswith(".class") and file not in classes
+                   and os.path.getmtime(os.path.join(bin_dir, file)) >= start]
+        classes.update(index_class_files(bin_dir, written))
+
+    index["installed"] = installed
+    save_compile_index(index)
+    return True
+
+
+# The steps of a build.  Each one raises BuildFailed with the matching code on
+# failure.
+def ask_user(question):
+    """Asks the user a yes or no question on the terminal."""
+    # We want this without a newline at the end, and print doesn't want to do
+    # that, even with a trailing comma.  *shrug*
+    sys.stdout.write(question + " (y/N) ")
+    return sys.stdin.readline().lower().startswith("y")
+
+def refuse(question):
+    """Answers no to a question, for builds with nobody to ask."""
+    print question, "(y/N) No one to ask; assuming not."
+    return False
+
+def run_command(command, cwd=None):
+    """Runs a command, returning its exit code.
+
+       command is either a shell command line or a list of arguments.
+
+       The command's output goes through sys.stdout, so that it follows the
+       rest of the build's output when that's been redirected (as by
+       BuildServer).
+    """
+    shell = isinstance(command, basestring)
+    if sys.stdout is sys.__stdout__:
+        return subprocess.call(command, shell=shell, cwd=cwd)
+
+    process = subprocess.Popen(command, shell=shell, cwd=cwd,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    for line in iter(process.stdout.readline, b""):
+        sys.stdout.write(line)
+    return process.wait()
+
+def prepare_directories():
+    # Create the project directory and force it to be seen as a category.
+    if not os.path.exists(USER):
+        os.makedirs(USER)
+
+        # Touch the CATEGORY file.
+        with open(os.path.join(USER, "CATEGORY"), "w") as catfile:
+            catfile.write("This is a placeholder file to mark this directory "
+                          "as a category, not a project.")
+
+    # Create the package directory.
+    if not os.path.exists(TARGET):
+        os.makedirs(TARGET)
+
+    # And the directories mcp_rebuild's own files go in, which a workspace or
+    # sandbox may not have yet.
+    for path in (SOURCE_BUNDLE, BUILD_CACHE, SRG_INDEX, BUILD_REPORT,
+                 PACKAGE_MANIFEST, PROJECT_CACHE, COMPILE_INDEX):
+        if path is not None and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+def reset_source(confirm=True, manifest=None, ask=None):
+    """STEP 1: Resets MCP_SRC to the state recorded in SOURCE_BUNDLE.
+
+       If SOURCE_BUNDLE doesn't exist yet, offers to create it instead.  In
+       "manifest" mode, manifest is used if given and up to date.  ask is used
+       for any questions (see reset_full).  Returns the manifest used, if any.
+    """
+    print "STEP 1: Cleaning MCP's source directory."
+    if SANDBOX is not None:
+        # mcp_rebuild made this source directory, so it's safe to delete.
+        confirm = False
+    if not os.path.exists(SOURCE_BUNDLE):
+        if (ask or ask_user)("Source bundle not found.  Is MCP's source directory clean?"):
+            print "Creating source bundle..."
+            create_snapshot(SOURCE_BUNDLE, SNAPSHOT_FORMAT)
+            if RESET_MODE == "manifest":
+                save_manifest()
+            print "Bundle created.  No need to clean the source directory."
+        else:
+            print "Clean MCP's source directory and run this script again."
+            raise BuildFailed(BUNDLE_MISSING)
+    elif RESET_MODE == "manifest":
+        if manifest is None or manifest.get("bundle") != bundle_stamp():
+            manifest = load_manifest()
+        if manifest is not None and os.path.isdir(MCP_SRC):
+            with REPORT.phase("reset") as stats:
+                stats["files"], stats["bytes"] = reset_changed(manifest)
+            return manifest
+        else:
+            print "No up-to-date source manifest; doing a full reset."
+            with REPORT.phase("reset") as stats:
+                stats["files"], stats["bytes"] = reset_full(confirm, ask)
+            save_manifest()
+    else:
+        with REPORT.phase("reset") as stats:
+            stats["files"], stats["bytes"] = reset_full(confirm, ask)
+
+    if RESET_MODE == "manifest":
+        return load_manifest()
+
+def discover_projects(only=None):
+    """Returns every active project under USER.
+
+       If only is given, it's a list of project names or directories (relative
+       to USER), and just those projects are returned.
+    """
+    projects = []
+    with REPORT.phase("collect_projects") as stats:
+        if os.path.isdir(USER):
+            cache = ProjectCache(PROJECT_CACHE)
+            Project.collect_projects(USER, projects, cache)
+            cache.save()
+        if only is not None:
+            projects = select_projects(projects, only)
+        stats["files"] = len(projects)
+    return projects
+
+def select_projects(projects, names):
+    """Picks out the named projects, warning about any names not found."""
+    selected = []
+    found = set()
+    for project in projects:
+        keys = set([project.name, os.path.basename(project.dir),
+                    os.path.relpath(project.dir, USER)])
+        matches = keys.intersection(names)
+        if matches:
+            selected.append(project)
+            found.update(matches)
+
+    for name in names:
+        if name not in found:
+            print "WARNING: No active project named %s." % name
+    return selected
+
+def install_projects(projects=None, only=None):
+    """STEP 2: Installs projects' source into MCP_SRC.
+
+       If projects is None, they are discovered first, limited to only (see
+       discover_projects).  Their precompiled code is planned, but not
+       installed until after recompiling.  Returns (projects, (plan,
+       precompiled_plan, precompiled_count)).
+    """
+    print "STEP 2: Installing projects."
+
+    # MCP's scripts rewrite files in src in place, which would write straight
+    # through a link into USER, so only reflinks are safe there.  bin is only
+    # ever deleted and recompiled, so its precompiled files can be linked.
+    if INSTALL_MODE == "copy":
+        plan = InstallPlan("copy")
+    else:
+        plan = InstallPlan("reflink")
+    precompiled_plan = InstallPlan(INSTALL_MODE)
+    precompiled_count = 0
+    if not os.path.isdir(USER):
+        print "No user directory found.  Leaving source clean."
+        save_install_log([])
+        return [], (plan, precompiled_plan, precompiled_count)
 
-print
-print "STEP 2: Installing projects."
+    if projects is None:
+        projects = discover_projects(only)
 
-projects = []
-if not os.path.isdir(USER):
-    print "No user directory found.  Leaving source clean."
-else:
-    Project.collect_projects(USER, projects)
     count = 0
     for project in projects:
-        if project.install():
+        if project.plan_install(plan):
             count += 1
+        if project.plan_install_precompiled(precompiled_plan):
+            precompiled_count += 1
+    plan.report_overrides()
+
+    # Forget the last run's installation until this one is complete, so
+    # that a failed install can't leave unrecorded files behind.
+    if os.path.exists(INSTALL_LOG):
+        os.remove(INSTALL_LOG)
+    with REPORT.phase("install") as stats:
+        stats["files"], stats["bytes"] = plan.execute(SRC_INSTALL_FAILED)
+    save_install_log(plan.files)
     print "%d project(s) installed." % count
 
-print
-print "STEP 3: Recompiling and reobfuscating."
-
-exit = subprocess.call(RECOMPILE, shell=True)
-if exit != 0:
-    print "Recompile failed.  Aborting."
-    sys.exit(RECOMPILE_FAILED)
-
-# Install pre-compiled code.
-count = 0
-for project in projects:
-    if project.install_precompiled():
-        count += 1
+    return projects, (plan, precompiled_plan, precompiled_count)
+
+def recompile_projects(plan, precompiled_plan, precompiled_count,
+                       use_cache=True, manifest=None):
+    """STEP 3: Recompiles and reobfuscates, or restores the cached result."""
+    print "STEP 3: Recompiling and reobfuscating."
+
+    cache_key = None
+    if BUILD_CACHE is not None:
+        with REPORT.phase("cache_key") as stats:
+            cache_key = build_cache_key([("src", plan),
+                                         ("bin", precompiled_plan)],
+                                        manifest)
+            stats["files"] = len(plan.files) + len(precompiled_plan.files)
+
+    if cache_key is not None and use_cache:
+        with REPORT.phase("cache_restore"):
+            restored = restore_cached_build(cache_key)
+        if restored:
+            print "Inputs unchanged; restored reobfuscated classes from the " \
+                  "cache."
+            return
+
+    compiled = False
+    if RECOMPILE_MODE == "incremental":
+        with REPORT.phase("compile_incremental") as stats:
+            compiled = compile_incremental(plan, stats)
+    elif os.path.exists(COMPILE_INDEX):
+        # It won't be kept up to date.
+        os.remove(COMPILE_INDEX)
+
+    if not compiled:
+        with REPORT.phase("recompile"):
+            exit = run_command(RECOMPILE, cwd=BASE)
+        if exit != 0:
+            print "Recompile failed.  Aborting."
+            raise BuildFailed(RECOMPILE_FAILED)
+
+        classpath = read_mcp_classpath()
+        if RECOMPILE_MODE == "incremental" and classpath is not None:
+            with REPORT.phase("compile_index") as stats:
+                index = build_compile_index(plan, classpath)
+                save_compile_index(index)
+                stats["files"] = sum(len(classes)
+                                     for classes in index["sides"].values())
+
+    # Install pre-compiled code.
+    precompiled_plan.report_overrides()
+    try:
+        with REPORT.phase("install_precompiled") as stats:
+            stats["files"], stats["bytes"] = precompiled_plan.execute(
+                BIN_INSTALL_FAILED, "install_precompiled")
+
+        print "Installed precompiled files for %d project(s)." \
+              % precompiled_count
+
+        with REPORT.phase("reobfuscate") as stats:
+            exit = run_command(REOBFUSCATE, cwd=BASE)
+            for (dir, subdirs, files) in os.walk(MCP_REOBF):
+                stats["files"] += len(files)
+                stats["bytes"] += sum(os.path.getsize(os.path.join(dir, file))
+                                      for file in files)
+    finally:
+        # Nothing else needs the precompiled files, and they must not be
+        # left where MCP could write through them into USER.
+        if RECOMPILE_MODE == "incremental":
+            # MCP_BIN is kept for the next compile, which mustn't see them
+            # either.  compile_incremental recompiles any class they replaced.
+            precompiled_plan.remove_files()
+        else:
+            precompiled_plan.remove_links()
+
+    if exit != 0:
+        print "Reobfuscate failed.  Aborting."
+        raise BuildFailed(REOBFUSCATE_FAILED)
+
+    if cache_key is not None:
+        with REPORT.phase("cache_store"):
+            store_cached_build(cache_key)
+
+    print "Recompiled and reobfuscated successfully."
+
+def package_step(projects, jobs):
+    """STEP 4: Packages projects into TARGET."""
+    print "STEP 4: Packaging projects."
+
+    Project.index_reobf()
+    with REPORT.phase("package") as stats:
+        package_count = package_projects(projects, jobs)
+        for project in projects:
+            package = REPORT.projects.get(project.name, {}).get("package", {})
+            stats["files"] += package.get("files", 0)
+            stats["bytes"] += package.get("bytes", 0)
+
+    print "%d project(s) compiled and packaged successfully." % package_count
+
+
+# Workspace locking.
+# How deeply the current thread holds WORKSPACE_LOCK.
+LOCK_STATE = threading.local()
+
+def lock_file(file, blocking):
+    """Takes an exclusive lock on file, returning False if blocking is False
+       and someone else has it.
+    """
+    if fcntl is not None:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(file.fileno(), flags)
+        except IOError:
+            if blocking:
+                raise
+            return False
+        return True
+
+    # msvcrt locks byte ranges, so everyone locks the first byte.  LK_LOCK
+    # only retries for 10 seconds, so keep asking.
+    while True:
+        file.seek(0)
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except IOError:
+            if not blocking:
+                return False
+            time.sleep(0.5)
 
-print "Installed precompiled files for %d project(s)." % count
+def unlock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextlib.contextmanager
+def workspace_lock(output=None):
+    """Holds WORKSPACE_LOCK for the body of a with statement, waiting for any
+       other build to finish first (and saying so on output, or sys.stdout).
+       A thread that already holds it can take it again.
+    """
+    if getattr(LOCK_STATE, "depth", 0):
+        LOCK_STATE.depth += 1
+        try:
+            yield
+        finally:
+            LOCK_STATE.depth -= 1
+        return
+
+    with open(WORKSPACE_LOCK, "a") as lock:
+        if not lock_file(lock, False):
+            output = output or sys.stdout
+            output.write("Waiting for another build in %s to finish...\n"
+                         % BASE)
+            output.flush()
+            lock_file(lock, True)
+        LOCK_STATE.depth = 1
+        try:
+            yield
+        finally:
+            LOCK_STATE.depth = 0
+            unlock_file(lock)
+
+def merge_requests(requests):
+    """Combines build requests (see run_queued) into one that covers them all.
+    """
+    merged = {"only": [], "steps": [], "jobs": 1, "use_cache": True}
+    for request in requests:
+        if merged["only"] is not None:
+            if request.get("only") is None:
+                merged["only"] = None
+            else:
+                merged["only"].extend(name for name in request["only"]
+                                      if name not in merged["only"])
+        for step in request.get("steps", Builder.STEPS):
+            if step not in merged["steps"]:
+                merged["steps"].append(step)
+        merged["jobs"] = max(merged["jobs"], request.get("jobs", 1))
+        merged["use_cache"] &= request.get("use_cache", True)
+    merged["steps"] = [step for step in Builder.STEPS
+                       if step in merged["steps"]]
+    return merged
+
+def write_json(filename, value):
+    """Writes value to filename as JSON, all at once."""
+    handle, temp_name = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(handle, "w") as temp_file:
+        json.dump(value, temp_file)
+    replace_file(temp_name, filename)
+
+def clean_build_queue():
+    """Removes results that have been waiting too long to be collected."""
+    cutoff = time.time() - STALE_RESULT_AGE
+    for name in os.listdir(BUILD_QUEUE):
+        filename = os.path.join(BUILD_QUEUE, name)
+        if name.endswith(".result") and os.path.getmtime(filename) < cutoff:
+            os.remove(filename)
+
+# This class stands in for sys.stdout, keeping a copy of everything written
+# through it.
+class CapturedOutput(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.text = []
+
+    def write(self, text):
+        self.stream.write(text)
+        self.text.append(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def getvalue(self):
+        return "".join(self.text)
+
+def run_queued(request, build, stdout=None):
+    """Runs request, a dict of Builder.build's arguments, once nobody else is
+       building in the workspace.
+
+       Requests that arrive while a build is running wait in BUILD_QUEUE.  The
+       first of them to get WORKSPACE_LOCK merges every waiting request into
+       one build, which it runs by calling build with the merged request, and
+       hands its result to the rest.  build returns the exit code, and is
+       only called in the caller that runs the build, with sys.stdout set to
+       stdout (or left alone, if that's None).
+
+       Returns (exit_code, output, report).  output is what the build printed
+       if another caller ran it, or None if this one did.
+    """
+    if not os.path.exists(BUILD_QUEUE):
+        os.makedirs(BUILD_QUEUE)
+    name = "%.6f-%d-%d" % (time.time(), os.getpid(),
+                           threading.current_thread().ident)
+    request_file = os.path.join(BUILD_QUEUE, name + ".request")
+    result_file = os.path.join(BUILD_QUEUE, name + ".result")
+    write_json(request_file, request)
+
+    try:
+        with workspace_lock(stdout):
+            if os.path.exists(result_file):
+                # Someone else's build covered this request.
+                with open(result_file) as result:
+                    result = json.load(result)
+                return result["exit_code"], result["output"], result["report"]
+
+            names = sorted(name[:-len(".request")]
+                           for name in os.listdir(BUILD_QUEUE)
+                           if name.endswith(".request"))
+            requests = []
+            for queued in names:
+                with open(os.path.join(BUILD_QUEUE, queued + ".request")) \
+                        as queued_file:
+                    requests.append(json.load(queued_file))
+            merged = merge_requests(requests)
+
+            previous = sys.stdout
+            output = CapturedOutput(stdout or previous)
+            sys.stdout = output
+            try:
+                if len(requests) > 1:
+                    print "Building for %d queued requests at once." \
+                          % len(requests)
+                exit_code = build(merged)
+            finally:
+                output.flush()
+                sys.stdout = previous
+
+            result = {"exit_code": exit_code, "output": output.getvalue(),
+                      "report": REPORT.as_dict()}
+            for queued in names:
+                if queued != name:
+                    write_json(os.path.join(BUILD_QUEUE, queued + ".result"),
+                               result)
+                os.remove(os.path.join(BUILD_QUEUE, queued + ".request"))
+            clean_build_queue()
+            return exit_code, None, result["report"]
+    finally:
+        # Only left behind if this caller was interrupted.
+        for filename in (request_file, result_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# Pipelining.
+# This class stands in for sys.stdout while a Pipeline runs.  It holds back
+# what each task prints until the task is waited for, so that it comes out in
+# one piece instead of mixed into everything else.
+class PipelineOutput(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.held = {} # Thread ident -> text.
+
+    def write(self, text):
+        held = self.held.get(threading.current_thread().ident)
+        if held is None:
+            self.stream.write(text)
+        else:
+            held.append(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def release(self, thread):
+        """Prints whatever thread's task held back."""
+        self.stream.write("".join(self.held.pop(thread.ident, [])))
+
+# This class runs the parts of a build that don't depend on each other at the
+# same time, each task in its own thread.  Tasks start as soon as the tasks
+# they need are done, and everything else in the build (chiefly waiting for
+# MCP) goes on in the meantime.  Use it in a with statement, which waits for
+# every task on the way out.
+class Pipeline(object):
+    def __init__(self):
+        self.tasks = {}
+        # Set once the build won't use what running tasks are working on.
+        # Long tasks should check it and give up early.
+        self.stopping = threading.Event()
+        self.output = None
+
+    def __enter__(self):
+        self.output = PipelineOutput(sys.stdout)
+        sys.stdout = self.output
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopping.set()
+        try:
+            for task in self.tasks.values():
+                task["thread"].join()
+                self.output.release(task["thread"])
+        finally:
+            sys.stdout = self.output.stream
+
+    def add(self, name, function, needs=()):
+        """Starts task name, which calls function with the results of the
+           tasks in needs, in order, once they're done.
+        """
+        task = {"result": None, "error": None}
+        def run():
+            self.output.held[threading.current_thread().ident] = []
+            try:
+                task["result"] = function(*[self.wait(need)
+                                            for need in needs])
+            except BaseException:
+                task["error"] = sys.exc_info()
+        task["thread"] = threading.Thread(target=run, name=name)
+        task["thread"].daemon = True
+        self.tasks[name] = task
+        task["thread"].start()
+
+    def wait(self, name):
+        """Waits for task name to finish, then returns its result, or raises
+           whatever it raised.
+        """
+        task = self.tasks[name]
+        # A join with a timeout, unlike one without, lets Ctrl-C through.
+        while task["thread"].is_alive():
+            task["thread"].join(1)
+        if threading.current_thread().ident not in self.output.held:
+            self.output.release(task["thread"])
+        if task["error"] is not None:
+            raise task["error"][0], task["error"][1], task["error"][2]
+        return task["result"]
+
+
+# This class is the importable interface to the build.  Unlike the command
+# line, it never reads from stdin and raises BuildFailed instead of exiting.
+# It keeps what it can between builds (the obfuscation maps and SOURCE_BUNDLE's
+# manifest), so a long-lived Builder skips most of the startup cost.
+class Builder(object):
+    STEPS = ("reset", "install", "recompile", "package")
+
+    def __init__(self, ask=None):
+        """ask is called with a yes or no question before anything risky is
+           done (see reset_source), and returns the answer.  If it's None,
+           the answer is always no.
+        """
+        check_settings()
+        prepare_directories()
+        self.ask = ask or refuse
+        self.manifest = None
+        self.srg_stamp = None
+
+    def load_obfuscation(self):
+        """Loads the obfuscation maps, unless they're loaded and current."""
+        stamp = [os.stat(filename).st_mtime
+                 for filename in (MCP_SRG_CLIENT, MCP_SRG_SERVER)]
+        if stamp != self.srg_stamp:
+            Project.load_obfuscation()
+            self.srg_stamp = stamp
 
-exit = subprocess.call(REOBFUSCATE, shell=True)
-if exit != 0:
-    print "Reobfuscate failed.  Aborting."
-    sys.exit(REOBFUSCATE_FAILED)
+    @classmethod
+    def check_steps(cls, steps):
+        """Raises ValueError unless steps are a set of STEPS that can run
+           together.
+        """
+        unknown = set(steps).difference(cls.STEPS)
+        if unknown:
+            raise ValueError("Unknown step(s): %s."
+                             % ", ".join(sorted(unknown)))
+        compile_steps = [step for step in cls.STEPS[:-1] if step in steps]
+        if compile_steps != list(cls.STEPS[:len(compile_steps)]):
+            raise ValueError("Each of %s needs the steps before it."
+                             % ", ".join(cls.STEPS[:-1]))
+
+    def build(self, only=None, steps=STEPS, jobs=1, use_cache=True,
+              report=None):
+        """Runs steps, which come from STEPS, for the projects in only.
+
+           only is as for discover_projects; None means every project.  Each
+           step needs the ones before it, except that "package" can run
+           without the rest, to repackage whatever MCP built last.  The
+           build's report is saved to report, or BUILD_REPORT by default.
+           The build holds WORKSPACE_LOCK, waiting for it if need be.
+
+           Returns the report as a dict.  Raises BuildFailed if the build
+           fails, or ValueError if steps don't make sense.
+        """
+        self.check_steps(steps)
+        steps = set(steps)
+        with workspace_lock():
+            REPORT.start()
+            try:
+                with Pipeline() as pipeline:
+                    self.run_steps(pipeline, only, steps, jobs, use_cache)
+                REPORT.exit_code = 0
+            except BuildFailed as e:
+                REPORT.exit_code = e.code
+                raise
+            finally:
+                Project.discard_prepared()
+                if report or BUILD_REPORT:
+                    REPORT.save(report or BUILD_REPORT)
+
+            return REPORT.as_dict()
+
+    def run_steps(self, pipeline, only, steps, jobs, use_cache):
+        """Runs steps (see build) for the projects in only.
+
+           The steps themselves run one after another, but finding projects
+           and loading the obfuscation maps happen alongside the reset, and
+           packaging gets a head start on everything but the class files while
+           MCP compiles.  Only the class files have to wait for MCP.
+        """
+        pipeline.add("discover", lambda: discover_projects(only))
+        if "package" in steps:
+            pipeline.add("obfuscation", self.load_obfuscation)
+            pipeline.add("prepare",
+                         lambda projects: prepare_packages(projects,
+                                                           pipeline.stopping),
+                         needs=["discover"])
+
+        if "reset" in steps:
+            self.manifest = reset_source(True, self.manifest, self.ask)
+            print
+
+        projects = pipeline.wait("discover")
+        if "install" in steps:
+            plans = install_projects(projects)[1]
+            print
+
+        if "recompile" in steps:
+            recompile_projects(*plans, use_cache=use_cache,
+                               manifest=self.manifest)
+            print
+
+        if "package" in steps:
+            # Whatever isn't prepared by now is quicker to do while packaging.
+            pipeline.stopping.set()
+            pipeline.wait("prepare")
+            pipeline.wait("obfuscation")
+            package_step(projects, jobs)
+
+
+# Watch mode.
+# How long USER has to be quiet before a burst of changes is rebuilt.
+WATCH_DEBOUNCE = 0.5
+# How often to look for changes when inotify isn't available.
+POLL_INTERVAL = 1.0
+
+
+# This class watches a directory tree with Linux's inotify, through ctypes.
+class InotifyWatcher(object):
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM \
+           | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, root):
+        """Raises OSError if inotify isn't available."""
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("no C library found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init"):
+            raise OSError("inotify is not supported")
+
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+        self.dirs = {}
+        self.add_tree(root)
+
+    def add_tree(self, root):
+        for (dir, subdirs, files) in os.walk(root, followlinks=True):
+            wd = self.libc.inotify_add_watch(self.fd, dir.encode("utf-8")
+                                             if not isinstance(dir, bytes)
+                                             else dir, self.MASK)
+            if wd >= 0:
+                self.dirs[wd] = dir
+
+    def wait(self, timeout=None):
+        """Returns the set of paths changed, waiting up to timeout seconds
+           (or forever) for the first change.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if wd not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[wd], name) if name \
+                   else self.dirs[wd]
+            changed.add(path)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE
+                                                | self.IN_MOVED_TO):
+                self.add_tree(path)
+
+        return changed
+
+
+# This class watches a directory tree by polling everything's mtime and size.
+class PollingWatcher(object):
+    def __init__(self, root):
+        self.root = root
+        self.state = self.scan()
+
+    def scan(self):
+        state = {}
+        for (dir, subdirs, files) in os.walk(self.root, followlinks=True):
+            for name in [dir] + [os.path.join(dir, file) for file in files]:
+                try:
+                    stat = os.stat(name)
+                except OSError:
+                    continue # Deleted while we were looking.
+                state[name] = (stat.st_mtime, stat.st_size)
+        return state
+
+    def wait(self, timeout=None):
+        """Returns the set of paths changed, waiting up to timeout seconds
+           (or forever) for the first change.
+        """
+        waited = 0
+        while True:
+            state = self.scan()
+            changed = set(name for name in set(state) | set(self.state)
+                          if state.get(name) != self.state.get(name))
+            self.state = state
+            if changed or (timeout is not None and waited >= timeout):
+                return changed
+
+            interval = POLL_INTERVAL
+            if timeout is not None:
+                interval = min(interval, timeout - waited)
+            time.sleep(interval)
+            waited += interval
+
+
+# This class implements --watch: it builds everything once, then waits for
+# changes in USER and redoes only the steps and projects they affect.  Project
+# discovery, the obfuscation maps and the source manifest stay in memory.
+class Watch(object):
+    def __init__(self, options):
+        self.options = options
+        self.projects = []
+        self.manifest = None
+        self.confirmed = False
+
+        try:
+            self.watcher = InotifyWatcher(USER)
+            print "Watching %s with inotify." % USER
+        except OSError:
+            self.watcher = PollingWatcher(USER)
+            print "Watching %s by polling." % USER
+
+    def build(self, compile, projects):
+        """Runs a build, returning False if it failed.
+
+           If compile is False, only packaging is done.  Only projects are
+           packaged.
+        """
+        with workspace_lock():
+            REPORT.start()
+            try:
+                with Pipeline() as pipeline:
+                    if compile:
+                        # Get projects' other files ready while MCP works.
+                        pipeline.add("prepare",
+                                     lambda: prepare_packages(
+                                         projects, pipeline.stopping))
+                        self.manifest = reset_source(not self.confirmed,
+                                                     self.manifest)
+                        self.confirmed = True
+                        print
+                        plans = install_projects(self.projects)[1]
+                        print
+                        recompile_projects(
+                            *plans, use_cache=not self.options.no_cache,
+                            manifest=self.manifest)
+                        print
+                        pipeline.stopping.set()
+                        pipeline.wait("prepare")
+                    package_step(projects, self.options.jobs)
+            except SystemExit as e:
+                REPORT.exit_code = e.code
+                if e.code in (UNSAFE_DELETE, BUNDLE_MISSING):
+                    raise
+                print "Build failed (exit code %s)." % e.code
+                return False
+            else:
+                REPORT.exit_code = 0
+                return True
+            finally:
+                Project.discard_prepared()
+                if self.options.report or BUILD_REPORT:
+                    REPORT.save(self.options.report or BUILD_REPORT)
 
-print "Recompiled and reobfuscated successfully."
-print
-print "STEP 4: Packaging projects."
+    def classify(self, changed):
+        """Works out what a set of changed paths needs.
 
-Project.load_obfuscation()
-package_count = 0
-for project in projects:
-    print "Packaging %s..." % project.name
-    os.chdir(BASE)
-    if project.package():
-        package_count += 1
+           Returns (rediscover, compile, projects): whether projects need to
+           be discovered again, whether MCP needs to recompile, and which
+           projects need packaging.
+        """
+        rediscover = False
+        compile = False
+        affected = set()
+        for path in changed:
+            name = os.path.basename(path)
+            if name.endswith("~") or name.startswith(".#") \
+               or name.endswith((".swp", ".swx")):
+                continue # Editor droppings.
+
+            for project in self.projects:
+                if path == project.dir \
+                   or path.startswith(os.path.join(project.dir, "")):
+                    break
+            else:
+                # Not inside a known project, so it may be a new one.
+                rediscover = True
+                continue
 
-print "%d project(s) compiled and packaged successfully." % package_count
+            relative_path = os.path.relpath(path, project.dir)
+            part = relative_path.split(os.path.sep)[0]
+            if part in (".", "DISABLED", "CATEGORY"):
+                rediscover = True
+            elif part in ("src", "bin"):
+                compile = True
+                affected.add(project.dir)
+            elif part == "conf":
+                # The project's name or packaging may have changed.
+                rediscover = True
+                affected.add(project.dir)
+            elif part == "resources":
+                affected.add(project.dir)
+
+        return rediscover, compile, affected
+
+    def run(self):
+        Project.load_obfuscation()
+        self.projects = discover_projects(self.options.only)
+        self.build(True, self.projects)
+
+        while True:
+            print
+            print "Waiting for changes..."
+            changed = self.watcher.wait()
+            # Let a burst of changes (like a save-all or a git checkout)
+            # finish before acting on it.
+            while True:
+                more = self.watcher.wait(WATCH_DEBOUNCE)
+                if not more:
+                    break
+                changed |= more
+
+            changed = set(path for path in changed
+                          if not path.startswith(os.path.join(TARGET, "")))
+            rediscover, compile, affected = self.classify(changed)
+
+            if rediscover:
+                old_dirs = set(project.dir for project in self.projects)
+                self.projects = discover_projects(self.options.only)
+                new_dirs = set(project.dir for project in self.projects)
+                if old_dirs != new_dirs:
+                    # Projects came or went, so their code did too.
+                    compile = True
+                    affected.update(new_dirs - old_dirs)
+
+            projects = [project for project in self.projects
+                        if project.dir in affected]
+            if not (compile or projects):
+                continue
+            if compile:
+                # Any project's classes can change when MCP recompiles, such
+                # as when two projects override the same Minecraft class.
+                # PACKAGE_MANIFEST leaves the unchanged packages alone.
+                projects = self.projects
+
+            print "Rebuilding %d project(s)%s." \
+                  % (len(projects), "" if compile else " (packaging only)")
+            self.build(compile, projects)
+
+
+# Build server.
+# This class stands in for sys.stdout while BuildServer runs a build, sending
+# each line printed to the client as an "output" event.  Everything is echoed
+# to the server's own stdout too.
+class EventStream(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffer = ""
+        self.lost = False
+        # Pipeline tasks report their phases from their own threads.
+        self.lock = threading.Lock()
+
+    def send(self, event):
+        with self.lock:
+            if self.lost:
+                return
+            try:
+                self.connection.sendall(json.dumps(event) + "\n")
+            except socket.error:
+                # The client went away.  Let the build finish anyway, rather
+                # than leave MCP half-built.
+                self.lost = True
+
+    def write(self, text):
+        sys.__stdout__.write(text)
+        self.buffer += text
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.send({"event": "output", "text": line + "\n"})
+
+    def flush(self):
+        sys.__stdout__.flush()
+        if self.buffer:
+            self.send({"event": "output", "text": self.buffer})
+            self.buffer = ""
+
+
+# This class implements --serve: a resident build server on a Unix socket.
+# Each connection sends one request, as a line of JSON like
+#   {"only": ["MyMod"], "steps": ["package"], "jobs": 4, "use_cache": true}
+# where every field is optional and they match Builder.build's arguments.  It
+# gets back lines of JSON: an "output" event for each line the build prints, a
+# "phase" event as each phase starts and ends, and finally a "result" event
+# with the exit code (0 for success) and the build's report.  Builds run one at
+# a time, and all of them share one Builder.
+class BuildServer(object):
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.builder = Builder()
+
+    def serve(self):
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                print "%s exists and isn't a socket.  Aborting." % self.path
+                raise BuildFailed(SERVER_FAILED)
+            os.remove(self.path) # Left over from an old server.
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.path)
+            listener.listen(5)
+            print "Serving builds on %s." % self.path
+            while True:
+                connection = listener.accept()[0]
+                # Each connection gets a thread, so that requests can queue
+                # up behind a running build and be merged (see run_queued).
+                thread = threading.Thread(target=self.serve_connection,
+                                          args=(connection,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def serve_connection(self, connection):
+        try:
+            self.handle(connection)
+        except socket.error:
+            pass # The client went away before sending its request.
+        finally:
+            connection.close()
+
+    def handle(self, connection):
+        """Runs the build requested on connection, or merges it into the
+           next build if one is already running.
+        """
+        events = EventStream(connection)
+        try:
+            request = json.loads(connection.makefile("rb").readline())
+            if not isinstance(request, dict):
+                raise ValueError("A request must be a JSON object.")
+            Builder.check_steps(request.get("steps", Builder.STEPS))
+        except ValueError as e:
+            events.send({"event": "result", "exit_code": SERVER_FAILED,
+                         "error": "Bad request: %s" % e})
+            return
+
+        errors = []
+        def build(request):
+            REPORT.listener = events.send
+            try:
+                self.builder.build(only=request["only"],
+                                   steps=request["steps"],
+                                   jobs=request["jobs"],
+                                   use_cache=request["use_cache"])
+                return 0
+            except BuildFailed as e:
+                return e.code
+            except Exception as e:
+                # Keep serving; the next request may do better.
+                traceback.print_exc(file=sys.stdout)
+                errors.append(str(e))
+                return SERVER_FAILED
+            finally:
+                REPORT.listener = None
+
+        exit_code, output, report = run_queued(request, build, events)
+        if output is not None:
+            # Another request's build covered this one.
+            events.send({"event": "output", "text": output})
+        events.flush()
+
+        result = {"event": "result", "exit_code": exit_code,
+                  "report": report}
+        if errors:
+            result["error"] = errors[0]
+        events.send(result)
+
+def request_build(path, request):
+    """Sends request to the BuildServer on path, printing its progress.
+
+       Returns the build's exit code.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error as e:
+        print "Unable to reach the build server on %s: %s" % (path, e)
+        return SERVER_FAILED
+
+    try:
+        connection.sendall(json.dumps(request) + "\n")
+        events = connection.makefile("rb")
+        for line in iter(events.readline, ""):
+            event = json.loads(line)
+            if event["event"] == "output":
+                sys.stdout.write(event["text"])
+                sys.stdout.flush()
+            elif event["event"] == "result":
+                if "error" in event:
+                    print event["error"]
+                return event["exit_code"]
+    finally:
+        connection.close()
+
+    print "Lost the connection to the build server."
+    return SERVER_FAILED
+
+
+# Matrix builds.
+def workspace_command(options, only=None):
+    """Returns the command line that builds in a workspace with options.
+
+       only, if given, replaces options.only.
+    """
+    command = [sys.executable, "-u", SCRIPT,
+               "--steps", ",".join(options.steps),
+               "--jobs", str(options.jobs)]
+    for name in (only if only is not None else options.only) or []:
+        command += ["--only", name]
+    if options.no_cache:
+        command.append("--no-cache")
+    return command
+
+def run_labelled(command, env, label, output_lock):
+    """Runs command with no stdin, printing each line of its output marked
+       with label.  Returns its exit code.
+    """
+    with open(os.devnull) as null:
+        process = subprocess.Popen(command, env=env, stdin=null,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, cwd=START_DIR)
+        for line in iter(process.stdout.readline, b""):
+            with output_lock:
+                sys.stdout.write("[%s] %s" % (label, line))
+                sys.stdout.flush()
+        return process.wait()
+
+def build_matrix(options):
+    """Builds in every workspace, each in its own process.
+
+       Up to --matrix-jobs (or MATRIX_JOBS) workspaces are built at once, with
+       each line of their output marked with the workspace's name.  They get
+       no stdin, so anything needing confirmation fails; build that workspace
+       alone with --workspace first.
+    """
+    names = sorted(WORKSPACES)
+    if not names:
+        print "No WORKSPACES in settings.py."
+        raise BuildFailed(UNCONFIGURED)
+
+    command = workspace_command(options)
+    output_lock = threading.Lock()
+    def build_workspace(name):
+        env = dict(os.environ, MCP_REBUILD_WORKSPACE=name)
+        return run_labelled(command, env, name, output_lock)
+
+    jobs = max(1, min(options.matrix_jobs or MATRIX_JOBS, len(names)))
+    pool = ThreadPool(jobs)
+    try:
+        exit_codes = pool.map(build_workspace, names)
+    finally:
+        pool.close()
+
+    print
+    for (name, exit_code) in zip(names, exit_codes):
+        if exit_code == 0:
+            print "%s: built successfully." % name
+        else:
+            print "%s: failed (exit code %s)." % (name, exit_code)
+
+    failures = [exit_code for exit_code in exit_codes if exit_code != 0]
+    if failures:
+        raise BuildFailed(failures[0])
+
+
+
+# Isolated builds.
+# The parts of MCP that MCP writes into, in place.  Sandboxes get their own
+# copies of these (cloned, where the filesystem can) and hardlinks to the rest.
+# MCP_BIN is among them since javac overwrites classes in place, which
+# RECOMPILE_MODE = "incremental" leaves it to do.
+SANDBOX_COPIED = (MCP_SRC, MCP_BIN, MCP_REOBF, relative("temp"),
+                  relative("logs"))
+# Records which SOURCE_BUNDLE a sandbox was cloned alongside.
+SANDBOX_STAMP = ".mcp_rebuild.sandbox"
+# Bump this whenever what clone_mcp copies changes, so old sandboxes are
+# cloned again.
+SANDBOX_VERSION = 3
+
+def sandbox_name(group):
+    """Turns a project's name or SANDBOX group into a directory name.
+
+       Names made only of dots (like "..") would point outside SANDBOXES, so
+       their dots are replaced too.
+    """
+    name = re.sub(r"[^\w.-]", "_", group)
+    if not name.strip("."):
+        name = name.replace(".", "_") or "_"
+    return name
+
+def sandbox_is_current(name):
+    """Returns True if sandbox name exists and matches SOURCE_BUNDLE."""
+    stamp_file = os.path.join(SANDBOXES, name, SANDBOX_STAMP)
+    if not os.path.exists(SOURCE_BUNDLE) or not os.path.isfile(stamp_file):
+        return False
+    with open(stamp_file) as stamp:
+        return json.load(stamp) == {"version": SANDBOX_VERSION,
+                                    "bundle": bundle_stamp()}
+
+def clone_mcp(name):
+    """Makes sandbox name a fresh copy of MCP, which must be clean.
+
+       mcp_rebuild's own files (USER, TARGET, SOURCE_BUNDLE, and the caches
+       and so on of every workspace) are left out.  Returns the number of
+       files and bytes cloned.
+    """
+    sandbox = os.path.join(SANDBOXES, name)
+    if os.path.dirname(os.path.realpath(sandbox)) \
+       != os.path.realpath(SANDBOXES):
+        print "Refusing to clone MCP into %s, which isn't in %s." \
+              % (sandbox, SANDBOXES)
+        raise BuildFailed(UNSAFE_DELETE)
+    if os.path.exists(sandbox):
+        shutil.rmtree(sandbox)
+
+    skipped = set(path for path in (SANDBOXES, USER, TARGET, SOURCE_BUNDLE,
+                                    SOURCE_MANIFEST, INSTALL_LOG,
+                                    WORKSPACE_LOCK, BUILD_QUEUE, BUILD_CACHE,
+                                    BUILD_REPORT, PACKAGE_MANIFEST,
+                                    PROJECT_CACHE, SRG_INDEX, COMPILE_INDEX)
+                  if path is not None)
+    # Along with every other workspace's files, which are beside these.  A
+    # state directory that's MAIN_BASE itself can't be left out whole, so
+    # only the workspaces' subdirectories of it are.
+    for dir in STATE_DIRS:
+        if dir != MAIN_BASE:
+            skipped.add(dir)
+        else:
+            skipped.update(os.path.join(dir, workspace)
+                           for workspace in WORKSPACES)
+    files = bytes = 0
+    for (dir, subdirs, filenames) in os.walk(BASE):
+        dest_dir = os.path.join(sandbox, os.path.relpath(dir, BASE))
+        os.makedirs(dest_dir)
+        copied = any(dir == copied_dir or dir.startswith(copied_dir + os.sep)
+                     for copied_dir in SANDBOX_COPIED)
+
+        for subdir in list(subdirs):
+            source = os.path.join(dir, subdir)
+            if source in skipped:
+                subdirs.remove(subdir)
+            elif os.path.islink(source):
+                # os.walk won't go into it, so copy the link itself.
+                os.symlink(os.readlink(source), os.path.join(dest_dir, subdir))
+
+        for filename in filenames:
+            source = os.path.join(dir, filename)
+            dest = os.path.join(dest_dir, filename)
+            if source in skipped:
+                continue
+            elif os.path.islink(source):
+                os.symlink(os.readlink(source), dest)
+                continue
+            elif not copied:
+                link_or_copy(source, dest)
+            elif not reflink_file(source, dest):
+                shutil.copy2(source, dest)
+            files += 1
+            bytes += os.path.getsize(source)
+
+    with open(os.path.join(sandbox, SANDBOX_STAMP), "w") as stamp:
+        json.dump({"version": SANDBOX_VERSION, "bundle": bundle_stamp()},
+                  stamp)
+    return files, bytes
+
+def build_isolated(options):
+    """Builds each project in a sandbox of its own, several at once.
+
+       Projects with the same SANDBOX setting share a sandbox.  Sandboxes are
+       copies of MCP under SANDBOXES, made from the clean MCP_SRC when they're
+       first needed (or when SOURCE_BUNDLE changes) and kept for later builds.
+       Up to --sandbox-jobs (or SANDBOX_JOBS) sandboxes are built at once,
+       each by its own rebuild.py with no stdin, and whether each project
+       built is reported separately.
+    """
+    REPORT.start()
+    try:
+        projects = discover_projects(options.only)
+        if not projects:
+            print "No projects to build."
+            REPORT.exit_code = 0
+            return
+
+        groups = collections.OrderedDict()
+        for project in projects:
+            name = sandbox_name(project.get_config("SANDBOX") or project.name)
+            groups.setdefault(name, []).append(project)
+
+        stale = [group_name for group_name in groups
+                 if not sandbox_is_current(group_name)]
+        if stale:
+            # Sandboxes are cloned from a clean MCP.
+            reset_source(True, None, ask_user)
+            print
+            with REPORT.phase("sandbox_clone") as stats:
+                for name in stale:
+                    print "Cloning MCP into sandbox %s..." % name
+                    files, bytes = clone_mcp(name)
+                    stats["files"] += files
+                    stats["bytes"] += bytes
+            print
+
+        output_lock = threading.Lock()
+        def build_sandbox(name):
+            only = [os.path.relpath(project.dir, USER)
+                    for project in groups[name]]
+            env = dict(os.environ, MCP_REBUILD_SANDBOX=name)
+            return run_labelled(workspace_command(options, only), env, name,
+                                output_lock)
+
+        names = list(groups)
+        jobs = options.sandbox_jobs or SANDBOX_JOBS \
+               or multiprocessing.cpu_count()
+        pool = ThreadPool(max(1, min(jobs, len(names))))
+        try:
+            with REPORT.phase("isolated_builds") as stats:
+                exit_codes = pool.map(build_sandbox, names)
+                stats["files"] = len(names)
+        finally:
+            pool.close()
+
+        print
+        failures = []
+        for (name, exit_code) in zip(names, exit_codes):
+            for project in groups[name]:
+                REPORT.projects.setdefault(project.name, {})["sandbox"] = \
+                    {"name": name, "exit_code": exit_code}
+                if exit_code == 0:
+                    print "%s: built successfully." % project.name
+                else:
+                    print "%s: failed (exit code %s, in sandbox %s)." \
+                          % (project.name, exit_code, name)
+                    failures.append(exit_code)
+        print "%d of %d project(s) built successfully." \
+              % (len(projects) - len(failures), len(projects))
+
+        if failures:
+            raise BuildFailed(failures[0])
+        REPORT.exit_code = 0
+    except BuildFailed as e:
+        REPORT.exit_code = e.code
+        raise
+    finally:
+        if options.report or BUILD_REPORT:
+            REPORT.save(options.report or BUILD_REPORT)
+
+
+def main():
+    options = parser.parse_args()
+
+    if options.workspace is not None and options.workspace != WORKSPACE:
+        # Start over in the workspace, so that every path points into it.
+        # The new process starts where this one did, so that relative paths
+        # on the command line still mean the same thing.
+        env = dict(os.environ, MCP_REBUILD_WORKSPACE=options.workspace)
+        sys.exit(subprocess.call([sys.executable, SCRIPT]
+                                 + sys.argv[1:], env=env, cwd=START_DIR))
+
+    if options.matrix:
+        build_matrix(options)
+        return
+
+    if options.connect:
+        sys.exit(request_build(options.connect,
+                               {"only": options.only,
+                                "steps": options.steps,
+                                "jobs": options.jobs,
+                                "use_cache": not options.no_cache}))
+
+    check_settings()
+    prepare_directories()
+
+    try:
+        Builder.check_steps(options.steps)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if options.isolated:
+        with workspace_lock():
+            build_isolated(options)
+        return
+
+    if options.convert_bundle:
+        with workspace_lock():
+            convert_bundle(options.convert_bundle)
+        return
+
+    if options.serve:
+        if not hasattr(socket, "AF_UNIX"):
+            parser.error("--serve needs Unix sockets, which this platform "
+                         "doesn't have.")
+        BuildServer(options.serve).serve()
+        return
+
+    if options.watch:
+        Watch(options).run()
+        return
+
+    if options.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def build(request):
+        try:
+            Builder(ask_user).build(request["only"], request["steps"],
+                                    request["jobs"], request["use_cache"],
+                                    options.report)
+        except BuildFailed as e:
+            return e.code
+        return 0
+
+    try:
+        exit_code, output, report = run_queued(
+            {"only": options.only, "steps": options.steps,
+             "jobs": options.jobs, "use_cache": not options.no_cache}, build)
+    finally:
+        if options.profile:
+            profiler.disable()
+            profiler.dump_stats(options.profile)
+
+    if output is not None:
+        print "Another build covered this one:"
+        sys.stdout.write(output)
+    if exit_code:
+        sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
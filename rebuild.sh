@@ -1,3 +1,3 @@
 #!/bin/bash
 cd `dirname "${BASH_SOURCE[0]}"`
-/usr/bin/env python rebuild.py
+/usr/bin/env python rebuild.py "$@"
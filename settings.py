@@ -2,7 +2,8 @@
 
 # All (current) configuration settings take the form of paths to specific files
 # or directories.  Aside from BASE itself, all paths are assumed to be relative
-# to BASE unless specified as absolute.
+# to BASE unless specified as absolute.  BASE is relative to the directory
+# rebuild.py is in.
 
 # Windows examples:
 # BASE = r"C:\MCP"
@@ -51,6 +52,128 @@ TARGET = r"mcp_rebuild/packages"
 # before installing user files.
 SOURCE_BUNDLE = r"mcp_rebuild/source.tbz2"
 
+# How SOURCE_BUNDLE is stored when it is created.  Also not a path.
+#   "bz2"   - A bzip2-compressed tarball.  Smallest, but slowest by far.
+#   "gz"    - A gzip-compressed tarball.  A little bigger, much faster.
+#   "xz"    - An xz (lzma) compressed tarball.  Small, and faster to restore
+#             than bz2.  Needs a Python with xz support or the xz command.
+#   "tar"   - An uncompressed tarball.  Big, but nearly as fast as a copy.
+#   "links" - A directory holding a read-only copy of MCP's source directory,
+#             restored by hardlinking instead of copying.  Restores are almost
+#             free if it's on the same filesystem as MCP.
+# Existing bundles are read in whatever format they were created in.  To
+# change the format of an existing bundle, run rebuild with
+# --convert-bundle FORMAT.
+SNAPSHOT_FORMAT = "bz2"
+
+# How MCP's source directory is reset before installing user files.  Also not a
+# path.
+#   "full"     - Delete the whole directory and restore it from SOURCE_BUNDLE.
+#                Slow, but asks for confirmation and doesn't trust anything.
+#   "manifest" - Keep a manifest of the clean directory (SOURCE_BUNDLE plus
+#                ".manifest") and a list of the files installed last run (plus
+#                ".installed"), and restore only the files that were changed,
+#                added or removed.  If nothing changed, nothing is restored.
+# Note that the "manifest" mode doesn't ask before deleting files it doesn't
+# recognize from MCP's source directory.
+RESET_MODE = "manifest"
+
+# How user files are put into MCP.  Also not a path.
+#   "copy"     - Copy every file.
+#   "reflink"  - Clone files so they share their data until one is changed,
+#                where the filesystem supports it (btrfs, XFS and others, on
+#                Linux).  Copies otherwise.
+#   "hardlink" - Hardlink precompiled files from bin/ into MCP's bin
+#                directory, and reflink the rest.
+#   "symlink"  - Symlink precompiled files, and reflink the rest.
+# Any file that can't be linked or cloned is copied.  Sources are never
+# hardlinked or symlinked, because MCP edits its source files in place and
+# would change your originals too.  Links in MCP's bin directory are removed as
+# soon as reobfuscation has read them.
+INSTALL_MODE = "copy"
+
+# How STEP 3 compiles.  Not a path.
+#   "full"        - Run MCP's recompile script, which compiles everything.
+#   "incremental" - Keep MCP's bin directory between runs, and use javac to
+#                   compile only the project files that changed, plus the
+#                   classes that use them.  Falls back to a full recompile
+#                   whenever that might not be enough: on the first run, after
+#                   SOURCE_BUNDLE or MCP's classpath (in conf/mcp.cfg)
+#                   changes, or if javac fails.
+RECOMPILE_MODE = "full"
+
+# The javac command "incremental" mode compiles with.  mcp_rebuild adds the
+# classpath, output directory and source files.  Not a path.
+JAVAC = r"javac -g -nowarn -source 1.6 -target 1.6"
+
+# Where "incremental" mode keeps its index of what was compiled last, and which
+# classes use which.
+COMPILE_INDEX = r"mcp_rebuild/compile.index"
+
+# Where to cache MCP's reobfuscated output, keyed by a hash of everything that
+# went into it (the clean source, your projects' source and precompiled files,
+# and MCP's obfuscation maps and scripts).  When nothing has changed since a
+# cached build, recompiling and reobfuscating are skipped entirely.  Set to
+# None to disable the cache.
+BUILD_CACHE = r"mcp_rebuild/cache"
+
+# How many cached builds to keep.  Not a path either.
+BUILD_CACHE_SIZE = 5
+
+# Where to keep an index of MCP's parsed obfuscation maps (conf/client.srg and
+# conf/server.srg), so they only need to be parsed again when they change.  Set
+# to None to parse them every run.
+SRG_INDEX = r"mcp_rebuild/srg.index"
+
+# Where to write a JSON report of each build: how long each step and each
+# project took, and how many files and bytes they handled.  Overridden by
+# --report.  Set to None to skip the report.
+BUILD_REPORT = r"mcp_rebuild/build_report.json"
+
+# Where to remember what went into each package in TARGET, so that packages
+# whose classes, resources and sources haven't changed are left alone instead
+# of being written again.  Set to None to write every package every run.
+PACKAGE_MANIFEST = r"mcp_rebuild/packages.json"
+
+# Where to remember which directories under USER are projects, categories or
+# disabled, along with each project's conf settings.  Directories whose mtimes
+# haven't changed are not searched or read again.  Set to None to search all of
+# USER every run.
+PROJECT_CACHE = r"mcp_rebuild/projects.cache"
+
+# Other MCP directories to build the same projects in, such as one for each
+# Minecraft version you support.  Each workspace has a name and its own BASE,
+# and can also have its own SOURCE_BUNDLE, TARGET and USER, relative to its
+# BASE.  USER defaults to the one above, and TARGET defaults to a subdirectory
+# of the one above, named after the workspace.  mcp_rebuild's own files (the
+# SOURCE_BUNDLE, unless the workspace has its own, and the caches, indexes and
+# reports below) go in a subdirectory named after the workspace next to the
+# usual ones, like mcp_rebuild/mc125/source.tbz2, so the workspace's BASE
+# needn't have anywhere to put them.  Package filenames get the workspace's TAG
+# (its name by default) added, like MyMod-1.0-mc125.zip.  Build in one
+# workspace with --workspace NAME, or in all of them with --matrix.  For
+# example:
+# WORKSPACES = {
+#     "mc125": {"BASE": r"~/mcp62"},
+#     "mc132": {"BASE": r"~/mcp72", "SOURCE_BUNDLE": r".source.tbz2"},
+# }
+WORKSPACES = {}
+
+# How many workspaces --matrix builds in at once.  Not a path.
+MATRIX_JOBS = 2
+
+# Where --isolated keeps its sandboxes: one copy of MCP for each project (or
+# each group of projects with the same conf/SANDBOX), so that a project that
+# fails to compile only fails itself.  Files MCP never changes are hardlinked
+# from BASE; the rest are cloned where the filesystem supports it, and copied
+# otherwise.  Sandboxes are kept between builds, and made again whenever
+# SOURCE_BUNDLE changes.
+SANDBOXES = r"mcp_rebuild/sandboxes"
+
+# How many sandboxes --isolated builds in at once.  None means one per CPU.
+# Not a path.
+SANDBOX_JOBS = None
+
 # Okay, I lied a little.  This one's not a path.  Just set it False once you've
 # configured the rest.
 UNCONFIGURED = True